@@ -0,0 +1,119 @@
+"""
+End-to-end benchmark of the dlg_json2csv.py command line against the local mock DLG API in mock_dlg.py, so runs
+are reproducible and need no network access. For each dataset size, a URL file with one search of that size (plus
+any single item URLs) is run through the CLI in a new process, and the time, requests/sec, records/sec and peak
+memory are reported. The stages are timed from the server's side: from the first to the last request of each kind.
+
+Usage: python benchmarks/bench_cli.py [--sizes 100 1000 10000] [--latency 0.02] [--per-page 20] [--max-per-page 100]
+                                      [--failure-rate 0.01] [--workers 4] [--items 10] [--cli-args "--stream"]
+"""
+
+import argparse
+import csv
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_dlg import MockDLG
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CLI = os.path.join(ROOT, 'dlg_json2csv.py')
+MAPPING = os.path.join(ROOT, 'DLG_Mapping.csv')
+
+
+def run_cli(arguments, log_name):
+    '''
+    Runs the CLI with arguments in a new process, with its output saved to log_name.
+    Returns (seconds, peak RSS in MB or None where it can't be measured, exit status).
+    '''
+    with open(log_name, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, CLI] + arguments, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            # wait4 gives the peak memory of this process alone, not of every process run so far.
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+            peak = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+        else:
+            process.wait()
+            peak = None
+        return time.perf_counter() - start, peak, process.returncode
+
+
+def count_rows(csv_name):
+    """Returns the number of rows in the CSV, not counting the header."""
+    if not os.path.exists(csv_name):
+        return 0
+    with open(csv_name, newline='', encoding='utf-8') as csv_file:
+        return max(0, sum(1 for _ in csv.reader(csv_file)) - 1)
+
+
+def stage_lines(stats):
+    """Returns a line for each kind of request with its count and how long it went on for."""
+    lines = []
+    for kind, kind_stats in sorted(stats.items(), key=lambda item: item[1]['first']):
+        seconds = kind_stats['last'] - kind_stats['first']
+        lines.append(f"    {kind}: {kind_stats['requests']} requests ({kind_stats['failed']} failed) "
+                     f"over {seconds:.2f} s")
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times dlg_json2csv.py end to end against a local mock DLG API.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='How many records are in the search for each run. [Default: 100 1000 10000]')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Seconds the mock server delays every response. [Default: 0.02]')
+    parser.add_argument('--per-page', type=int, default=20,
+                        help='Records per page of a search that does not ask for a page size. [Default: 20]')
+    parser.add_argument('--max-per-page', type=int, default=100,
+                        help='The most records the mock server puts on a page. [Default: 100]')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='The fraction of requests the mock server answers with a 503. [Default: 0]')
+    parser.add_argument('--workers', type=int, default=4, help='--workers for the CLI. [Default: 4]')
+    parser.add_argument('--items', type=int, default=0,
+                        help='How many single item URLs to add to the URL file. [Default: 0]')
+    parser.add_argument('--cli-args', type=str, default='',
+                        help='Other arguments for the CLI, in quotes, such as "--stream". [Default: none]')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for which requests fail. [Default: 0]')
+    args = parser.parse_args()
+
+    server = MockDLG(0, args.latency, args.per_page, args.failure_rate, args.seed, args.max_per_page).start()
+    print(f'Mock DLG API at {server.base_url}: {args.latency * 1000:.0f} ms latency, {args.per_page} per page, '
+          f'{args.failure_rate:.1%} failure rate')
+
+    with tempfile.TemporaryDirectory() as folder:
+        for size in args.sizes:
+            url_file = os.path.join(folder, f'urls_{size}.txt')
+            csv_name = os.path.join(folder, f'output_{size}.csv')
+            with open(url_file, 'w') as urls:
+                urls.write(f'{server.base_url}/records?size={size}\n')
+                # Single items from past the end of the search, so none are duplicates.
+                for number in range(size, size + args.items):
+                    urls.write(f'{server.base_url}/record/dlg_bench_{number}\n')
+
+            server.reset()
+            arguments = ['--input', url_file, '--output', csv_name, '--mapping', MAPPING,
+                         '--workers', str(args.workers)] + shlex.split(args.cli_args)
+            seconds, peak, status = run_cli(arguments, os.path.join(folder, f'log_{size}.txt'))
+            stats = server.report()
+            requests = sum(kind_stats['requests'] for kind_stats in stats.values())
+            rows = count_rows(csv_name)
+
+            print(f'\n{size} records in the search, {args.items} single items')
+            if status != 0:
+                with open(os.path.join(folder, f'log_{size}.txt')) as log:
+                    print(f'  The CLI exited with status {status}:\n' + log.read())
+                continue
+            print(f'  {seconds:.2f} s, {requests} requests ({requests / seconds:,.1f} requests/s), '
+                  f'{rows} rows ({rows / seconds:,.1f} records/s), '
+                  f'peak RSS {"unknown" if peak is None else f"{peak:.1f} MB"}')
+            print('  Stages:')
+            for line in stage_lines(stats):
+                print(line)
+
+    server.shutdown()
@@ -0,0 +1,85 @@
+"""
+Startup benchmark for dlg_json2csv.py, to catch changes that make the script slow to start. Uses python -X importtime
+to time importing each module in a new process, reports the slowest imports, and times `dlg_json2csv.py --help` end
+to end. Exits with status 1 if a module takes longer than --budget-ms to import, or imports one of the heavy modules
+in --forbid, which should only be imported when they are used.
+
+The GUI can't be imported without opening its window, so its startup is checked through the modules it imports.
+
+Usage: python benchmarks/bench_import.py [--modules dlg_json2csv] [--repeat 5] [--budget-ms 150] [--top 10]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CLI = os.path.join(ROOT, 'dlg_json2csv.py')
+
+# Imported only when they are used.
+HEAVY = ['pandas', 'requests', 'pyarrow', 'multiprocessing', 'numpy']
+
+
+def import_times(module):
+    '''
+    Imports module in a new process with -X importtime. Returns the total microseconds for module and a dictionary
+    of every module imported to its own (self) microseconds.
+    '''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    total = None
+    imported = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        imported[name.strip()] = int(own)
+        if name.strip() == module:
+            total = int(cumulative)
+    return total, imported
+
+
+def help_seconds():
+    """Returns how long `dlg_json2csv.py --help` takes, from starting Python to exiting."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, CLI, '--help'], cwd=ROOT, capture_output=True, check=True)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times how long the script takes to start.')
+    parser.add_argument('--modules', nargs='+', default=['dlg_json2csv'],
+                        help='The modules to time importing. [Default: dlg_json2csv]')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of each, of which the median is used. [Default: 5]')
+    parser.add_argument('--budget-ms', type=float, default=150,
+                        help='Fail if a module takes longer than this to import. [Default: 150]')
+    parser.add_argument('--forbid', nargs='*', default=HEAVY,
+                        help=f'Fail if importing a module imports one of these. [Default: {" ".join(HEAVY)}]')
+    parser.add_argument('--top', type=int, default=10, help='How many of the slowest imports to list. [Default: 10]')
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        runs = [import_times(module) for _ in range(args.repeat)]
+        total_ms = statistics.median(total for total, imported in runs) / 1000
+        imported = runs[-1][1]
+
+        print(f'import {module}: {total_ms:.1f} ms (median of {args.repeat})')
+        for name, own in sorted(imported.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+            print(f'  {own / 1000:7.1f} ms  {name}')
+
+        heavy = sorted(name for name in imported if name.split('.')[0] in args.forbid)
+        if heavy:
+            failed = True
+            print(f'  FAIL: imports {", ".join(heavy)} at startup')
+        if total_ms > args.budget_ms:
+            failed = True
+            print(f'  FAIL: over the budget of {args.budget_ms:.0f} ms')
+
+    seconds = statistics.median(help_seconds() for _ in range(args.repeat))
+    print(f'dlg_json2csv.py --help: {seconds * 1000:.0f} ms (median of {args.repeat})')
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,125 @@
+"""
+Micro-benchmark for the transform stage of dlg_json2csv.py on synthetic records, with no network access.
+Compares the old approach (flatten every field with repeated string concatenation, then DataFrame drop, rename and
+sort_index) with to_row (project to the mapped fields, join lists once, rename in the same pass).
+Redirect resolution is left out since it is network work. Also measures the memory each kept record takes as the
+full DLG JSON and as a row dictionary, and how long a page of JSON takes to decode with json and,
+if it is installed, orjson.
+
+Usage: python benchmarks/bench_transform.py [--records 100000] [--values 1 5 20]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dlg_json2csv import load_mapping, orjson, to_row  # noqa: E402
+
+MAPPING = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'DLG_Mapping.csv')
+
+
+def make_records(count, values):
+    """Makes count synthetic DLG records, each with mapped and unmapped multi-valued fields of values entries."""
+    records = []
+    for number in range(count):
+        record = {'id': f'dlg_bench_{number}', 'edm_is_shown_by': [f'https://example.org/{number}.jpg']}
+        for field in ('dcterms_title', 'dcterms_creator', 'dcterms_subject', 'dcterms_description', 'dc_date',
+                      'dcterms_spatial', 'dcterms_type', 'dc_format', 'dc_right', 'dcterms_is_part_of',
+                      'edm_is_shown_at', 'dcterms_identifier'):
+            record[field] = [f'{field} value {i} of record {number}' for i in range(values)]
+        # Fields the mapping drops.
+        for field in ('year_facet', 'counties_facet', 'collection_titles_sms', 'dlg_admin_notes', 'created_at'):
+            record[field] = [f'{field} {i}' for i in range(values)]
+        record['fulltext'] = 'Unmapped full text. ' * 50
+        records.append(record)
+    return records
+
+
+def legacy_transform(records, new_column_name):
+    """The transform as it was: flattens every field of every record, then drops, renames and sorts in pandas."""
+    for item in records:
+        for key in item.keys():
+            if type(item[key]) == list:
+                text = item[key][0]
+                for i in range(1, len(item[key])):
+                    text += ', ' + item[key][i]
+                item[key] = text
+    df = pd.DataFrame.from_dict(records)
+    drop_columns = [col for col in list(df.columns) if col not in list(new_column_name.keys())]
+    df.drop(drop_columns, axis=1, inplace=True)
+    df.rename(columns=new_column_name, inplace=True)
+    return df.sort_index(axis=1)
+
+
+def single_pass_transform(records, new_column_name):
+    """The transform as it is now: one row per record with to_row, then one DataFrame with the columns in order."""
+    rows = [to_row(item, new_column_name) for item in records]
+    columns = sorted(set(column for row in rows for column in row))
+    return pd.DataFrame(rows, columns=columns)
+
+
+def bytes_per_record(make, records):
+    """Returns how many bytes each of the values make(record) makes for records takes, while they are all kept."""
+    tracemalloc.start()
+    kept = [make(record) for record in records]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / len(kept)
+
+
+def decode_seconds(loads, text, repeat=20):
+    """Returns the average time loads takes to decode text."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        loads(text)
+    return (time.perf_counter() - start) / repeat
+
+
+def time_it(function, records, new_column_name):
+    start = time.perf_counter()
+    result = function(records, new_column_name)
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times the old and new transform stage on synthetic records.')
+    parser.add_argument('--records', type=int, default=100000, help='How many synthetic records. [Default: 100000]')
+    parser.add_argument('--values', type=int, nargs='+', default=[1, 5, 20],
+                        help='Values in each multi-valued field; one run for each. [Default: 1 5 20]')
+    args = parser.parse_args()
+
+    new_column_name = load_mapping(MAPPING)
+
+    for values in args.values:
+        # Each approach gets its own records, since the old one changes them in place.
+        legacy_seconds, legacy = time_it(legacy_transform, make_records(args.records, values), new_column_name)
+        single_seconds, single = time_it(single_pass_transform, make_records(args.records, values), new_column_name)
+
+        assert legacy.fillna('').astype(str).equals(single.fillna('').astype(str)), 'The two transforms disagree.'
+        del legacy, single
+
+        print(f'{args.records} records, {values} values per multi-valued field')
+        print(f'  old (flatten all fields, drop/rename/sort): {legacy_seconds:.2f} s '
+              f'({args.records / legacy_seconds:,.0f} records/s)')
+        print(f'  new (to_row single pass):                   {single_seconds:.2f} s '
+              f'({args.records / single_seconds:,.0f} records/s)')
+        print(f'  speedup: {legacy_seconds / single_seconds:.1f}x')
+
+    records = make_records(min(args.records, 20000), args.values[-1])
+    print(f'\nMemory for each kept record, {args.values[-1]} values per multi-valued field')
+    print(f'  full DLG JSON:   {bytes_per_record(lambda item: json.loads(json.dumps(item)), records):,.0f} bytes')
+    print(f'  row dictionary:  {bytes_per_record(lambda item: to_row(item, new_column_name), records):,.0f} bytes')
+
+    page = json.dumps({'response': {'docs': records[:100]}}).encode('utf-8')
+    print(f'\nDecoding a page of 100 records ({len(page) / 1024:,.0f} KB)')
+    print(f'  json:   {decode_seconds(json.loads, page) * 1000:.2f} ms')
+    if orjson is not None:
+        print(f'  orjson: {decode_seconds(orjson.loads, page) * 1000:.2f} ms')
+    else:
+        print('  orjson: not installed')
@@ -0,0 +1,123 @@
+"""
+Checks that a --stream harvest killed part way through, like a crash or power cut would, is finished by --resume with
+every item exactly once. For each of the --kill-after times, dlg_json2csv.py is run against the mock DLG API in
+mock_dlg.py, killed that many seconds in (if it has not finished), and then run again with --resume until it
+finishes. Each kill time is run with the search whole and split with --shard-pages. The mock leaves the year off
+some records, so the sharded search also has to be walked as a whole for those records; a kill can land before,
+during or after that walk.
+Both runs save the DLG's responses with --save-raw, and the CSV is then made again from them with --from-raw.
+Exits with status 1 if any resumed or replayed CSV is missing items, has an item twice, or a journal was left behind.
+
+Usage: python benchmarks/check_resume.py [--size 1000] [--kill-after 1 3 6] [--latency 0.02] [--shard-pages 5]
+"""
+
+import argparse
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_dlg import MockDLG
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CLI = os.path.join(ROOT, 'dlg_json2csv.py')
+MAPPING = os.path.join(ROOT, 'DLG_Mapping.csv')
+
+# The mapped column with a different value for every item: its DLG page.
+ID_COLUMN = 'Is Referenced By'
+
+
+def item_links(csv_name):
+    """Returns the ID_COLUMN value of every row in the CSV, in order."""
+    with open(csv_name, newline='', encoding='utf-8') as csv_file:
+        return [row[ID_COLUMN] for row in csv.DictReader(csv_file)]
+
+
+def run_killed(arguments, log, seconds):
+    """Runs the CLI with arguments, killing it if it is still running after seconds. Returns True if it was killed."""
+    process = subprocess.Popen([sys.executable, CLI] + arguments, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        process.wait(seconds)
+        return False
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        return True
+
+
+def check(csv_name, size):
+    """Returns a list of the problems with the CSV, which should have size items."""
+    name = os.path.basename(csv_name)
+    problems = []
+    links = item_links(csv_name) if os.path.exists(csv_name) else []
+    if len(links) != size:
+        problems.append(f'{name} has {len(links)} rows instead of {size}')
+    if len(set(links)) != len(links):
+        problems.append(f'{name} has {len(links) - len(set(links))} items more than once')
+    if os.path.exists(csv_name + '.journal'):
+        problems.append(f'the journal for {name} was left behind')
+    return problems
+
+
+def kill_and_resume(base_url, size, seconds, shard_pages, workers):
+    '''
+    Runs a harvest of a search of size records from the mock at base_url, kills it after seconds, resumes it and
+    replays its raw file. Returns (whether it was killed, a list of problems, the log of the runs).
+    '''
+    with tempfile.TemporaryDirectory() as folder:
+        url_file = os.path.join(folder, 'urls.txt')
+        with open(url_file, 'w') as urls:
+            urls.write(f'{base_url}/records?size={size}\n')
+        csv_name = os.path.join(folder, 'output.csv')
+        raw_name = os.path.join(folder, 'raw.jsonl.gz')
+        replay_name = os.path.join(folder, 'replay.csv')
+        arguments = ['--input', url_file, '--output', csv_name, '--mapping', MAPPING, '--workers', str(workers),
+                     '--shard-pages', str(shard_pages), '--stream', '--save-raw', raw_name, '--no-progress']
+
+        with open(os.path.join(folder, 'log.txt'), 'w') as log:
+            killed = run_killed(arguments, log, seconds)
+            resumed = subprocess.run([sys.executable, CLI] + arguments + ['--resume'], cwd=ROOT, stdout=log,
+                                     stderr=subprocess.STDOUT)
+            replayed = subprocess.run([sys.executable, CLI, '--from-raw', raw_name, '--output', replay_name,
+                                       '--mapping', MAPPING, '--no-progress'], cwd=ROOT, stdout=log,
+                                      stderr=subprocess.STDOUT)
+        problems = check(csv_name, size) + check(replay_name, size)
+        if resumed.returncode != 0:
+            problems.append(f'--resume exited with status {resumed.returncode}')
+        if replayed.returncode != 0:
+            problems.append(f'--from-raw exited with status {replayed.returncode}')
+        with open(os.path.join(folder, 'log.txt')) as log:
+            return killed, problems, log.read()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks that killed --stream harvests are finished by --resume.')
+    parser.add_argument('--size', type=int, default=1000, help='How many records are in the search. [Default: 1000]')
+    parser.add_argument('--kill-after', type=float, nargs='+', default=[1, 3, 6],
+                        help='Seconds after starting to kill each run. [Default: 1 3 6]')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Seconds the mock server delays every response. [Default: 0.02]')
+    parser.add_argument('--shard-pages', type=int, default=5,
+                        help='--shard-pages for the sharded runs. Every kill time is also run without. [Default: 5]')
+    parser.add_argument('--workers', type=int, default=4, help='--workers for the CLI. [Default: 4]')
+    args = parser.parse_args()
+
+    server = MockDLG(0, args.latency, missing_years=True).start()
+    failed = False
+    for shard_pages in (0, args.shard_pages):
+        print('Sharded into years' if shard_pages else 'Not sharded')
+        for seconds in args.kill_after:
+            start = time.perf_counter()
+            killed, problems, log = kill_and_resume(server.base_url, args.size, seconds, shard_pages, args.workers)
+            print(f'  Killed after {seconds:g} s' if killed else f'  Finished before {seconds:g} s', end=': ')
+            if problems:
+                failed = True
+                print('FAIL, ' + ', '.join(problems) + '\n' + log)
+            else:
+                print(f'OK, {args.size} items after resuming and replaying '
+                      f'({time.perf_counter() - start:.1f} s in all)')
+
+    server.shutdown()
+    sys.exit(1 if failed else 0)
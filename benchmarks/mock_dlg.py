@@ -0,0 +1,239 @@
+"""
+A local stand-in for the DLG API, so dlg_json2csv.py can be timed without touching the live site.
+It makes up its records on the fly from their ids, so a search of any size uses no memory to serve.
+
+Routes:
+  /records.json?size=N[&page=P][&per_page=M]   A search result of N records, one page at a time (at most
+                                               max_per_page records a page), with the
+                                               response.pages.total_pages and response.docs the DLG gives,
+                                               and a year_facet in response.facets. f[year_facet][]=Y
+                                               filters it to the records from year Y. With missing_years,
+                                               1 in 7 records has no year and 1 in 3 of the rest has two,
+                                               so the year counts add up to more than the search while
+                                               some records are in no year.
+  /record/<id>.json                            A single item, in response.document.
+  /files/<id>                                  Redirects to the item's file, like edm_is_shown_by links do.
+  /<repo>/<collection>/do-th:<item>            Redirects to the item's thumbnail.
+  /blob/<name>                                 Where the redirects end up. A small body for GET, none for HEAD.
+
+Every response is delayed by latency seconds, and failure_rate of them are a 503 so the retries get exercised.
+Half the records link their file through /files/ and half through the thumbnail route, since thumbnail_url in
+dlg_json2csv.py always points at the real DLG for items without a file link.
+
+Usage: python benchmarks/mock_dlg.py [--port 8000] [--latency 0.05] [--per-page 20] [--max-per-page 100]
+                                    [--failure-rate 0.01] [--missing-years]
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+
+# Record number n is from year 1900 + n % YEARS, and with missing_years, also from 1900 + YEARS if n % 3 == 0.
+YEARS = 50
+
+
+def record_years(number, missing_years=False):
+    """Returns the years of record number."""
+    if not missing_years:
+        return [1900 + number % YEARS]
+    if number % 7 == 0:
+        return []
+    return [1900 + number % YEARS] + ([1900 + YEARS] if number % 3 == 0 else [])
+
+
+def make_record(base_url, number, missing_years=False):
+    """Makes the DLG JSON for record number, with mapped and unmapped fields like the real API has."""
+    item_id = f'dlg_bench_{number}'
+    record = {'id': item_id, 'updated_at': '2020-01-01T00:00:00.000Z'}
+    for field in ('dcterms_title', 'dcterms_creator', 'dcterms_subject', 'dcterms_description', 'dc_date',
+                  'dcterms_spatial', 'dcterms_type', 'dc_format', 'dc_right', 'dcterms_is_part_of',
+                  'dcterms_identifier'):
+        record[field] = [f'{field} value {i} of record {number}' for i in range(1 + number % 3)]
+    record['edm_is_shown_at'] = [f'{base_url}/record/{item_id}']
+    if number % 2:
+        record['edm_is_shown_by'] = [f'{base_url}/files/{item_id}']
+    else:
+        record['edm_is_shown_by'] = [f'{base_url}/dlg/bench/do-th:{number}']
+    # Fields the mapping drops.
+    years = record_years(number, missing_years)
+    if years:
+        record['year_facet'] = [str(year) for year in years]
+    for field in ('counties_facet', 'collection_titles_sms', 'created_at'):
+        record[field] = [f'{field} {number}']
+    record['fulltext'] = 'Unmapped full text. ' * 20
+    return record
+
+
+class MockDLG(ThreadingHTTPServer):
+    '''
+    The mock DLG server. Keeps a count of the requests of each kind, and when the
+    first and last of them came in, for report().
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, per_page=20, failure_rate=0.0, seed=None, max_per_page=100,
+                 missing_years=False):
+        super().__init__(('127.0.0.1', port), MockHandler)
+        self.latency = latency
+        self.per_page = per_page
+        self.max_per_page = max_per_page
+        self.failure_rate = failure_rate
+        self.missing_years = missing_years
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:' + str(self.server_address[1])
+
+    def reset(self):
+        """Clears the request counts, so each benchmark run is reported on its own."""
+        with self.lock:
+            self.stats = {}
+
+    def count(self, kind):
+        """Records a request of kind and returns True if it should fail."""
+        now = time.monotonic()
+        with self.lock:
+            stats = self.stats.setdefault(kind, {'requests': 0, 'failed': 0, 'first': now, 'last': now})
+            stats['requests'] += 1
+            stats['last'] = now
+            failed = self.random.random() < self.failure_rate
+            if failed:
+                stats['failed'] += 1
+        return failed
+
+    def report(self):
+        """Returns a copy of the stats for each kind of request: its count, failures, and first and last times."""
+        with self.lock:
+            return {kind: dict(stats) for kind, stats in self.stats.items()}
+
+    def handle_error(self, request, client_address):
+        """Ignores clients that go away part way through a response, like a harvest that was killed."""
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        """Serves requests in a background thread and returns self."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Answers one request to the MockDLG, which is self.server."""
+
+    # Keep-alive, so the client's connection pooling is measured too.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body=b'', content_type='application/json', location=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if location:
+            self.send_header('Location', location)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_json(self, value):
+        self.send(200, json.dumps(value).encode('utf-8'))
+
+    def route(self):
+        """Returns the kind of request and the function that answers it."""
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        path = parts.path
+
+        if path == '/records.json':
+            return 'search', lambda: self.search(query)
+        match = re.fullmatch(r'/record/(dlg_bench_(\d+))\.json', path)
+        if match:
+            return 'record', lambda: self.send_json({'response': {'document': make_record(
+                self.server.base_url, int(match.group(2)), self.server.missing_years)}})
+        match = re.fullmatch(r'/files/([^/]+)', path)
+        if match:
+            return 'redirect', lambda: self.send(302, location='/blob/' + quote(match.group(1)) + '.jpg')
+        match = re.fullmatch(r'/[^/]+/[^/]+/do-th:([^/]+)', path)
+        if match:
+            return 'redirect', lambda: self.send(302, location='/blob/th_' + quote(match.group(1)) + '.jpg')
+        if path.startswith('/blob/'):
+            return 'file', lambda: self.send(200, b'\xff' * 1024, 'image/jpeg')
+        return 'missing', lambda: self.send(404, b'{}')
+
+    def search(self, query):
+        """A page of the search result, per_page records at a time, optionally from one year."""
+        size = int(query.get('size', ['100'])[0])
+        page = int(query.get('page', ['1'])[0])
+        per_page = min(self.server.max_per_page, int(query.get('per_page', [self.server.per_page])[0]))
+        missing_years = self.server.missing_years
+        numbers = range(size)
+        if 'f[year_facet][]' in query:
+            numbers = self.year_numbers(size, int(query['f[year_facet][]'][0]))
+        total_pages = max(1, math.ceil(len(numbers) / per_page))
+        first = (page - 1) * per_page
+        docs = [make_record(self.server.base_url, number, missing_years) for number in numbers[first:first + per_page]]
+        if missing_years:
+            in_search = sorted({year for number in numbers for year in record_years(number, True)})
+        else:
+            in_search = sorted({1900 + number % YEARS for number in numbers[:YEARS]})
+        years = [{'value': str(year), 'hits': len(self.year_numbers(size, year)), 'label': str(year)}
+                 for year in in_search]
+        self.send_json({'response': {'docs': docs, 'facets': [{'name': 'year_facet', 'items': years}], 'pages': {
+            'current_page': page, 'total_pages': total_pages, 'total_count': len(numbers), 'per_page': per_page,
+            'first_page?': page == 1, 'last_page?': page >= total_pages}}})
+
+    def year_numbers(self, size, year):
+        """The numbers of the records in a search of size records that are from year."""
+        if not self.server.missing_years:
+            return range(year - 1900, size, YEARS)
+        return [number for number in range(size) if year in record_years(number, True)]
+
+    def answer(self):
+        kind, respond = self.route()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.count(kind):
+            self.send(503, b'{}')
+        else:
+            respond()
+
+    def do_GET(self):
+        self.answer()
+
+    def do_HEAD(self):
+        self.answer()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs a local stand-in for the DLG API until stopped.')
+    parser.add_argument('--port', type=int, default=8000, help='The port to listen on. [Default: 8000]')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to delay every response. [Default: 0]')
+    parser.add_argument('--per-page', type=int, default=20,
+                        help='Records per page of a search without per_page. [Default: 20]')
+    parser.add_argument('--max-per-page', type=int, default=100,
+                        help='The most records a page can have, whatever per_page asks for. [Default: 100]')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='The fraction of requests that get a 503. [Default: 0]')
+    parser.add_argument('--missing-years', action='store_true',
+                        help='Leave the year off some records and give others two. [Default: every record has one]')
+    args = parser.parse_args()
+
+    server = MockDLG(args.port, args.latency, args.per_page, args.failure_rate, max_per_page=args.max_per_page,
+                     missing_years=args.missing_years)
+    print(f'Serving a mock DLG API at {server.base_url}, for example {server.base_url}/records?size=1000')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
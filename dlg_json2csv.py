@@ -1,138 +1,1521 @@
 import argparse
 import sys
 import json
-import requests
 import csv
 import re
-import pandas as pd
+import os
+import time
+import hashlib
+import importlib.util
+import gzip
+import threading
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
+#requests, and multiprocessing for --processes, are imported when they are first used, so the script starts
+#quickly and runs that don't need them (like --from-raw, or --help) never pay for them.
 
+#orjson decodes JSON several times faster, and is used if it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def dlg_json2list(url_list):
 
-    list_json = []
 
+def loads(text):
+    """Decodes JSON text (str or bytes), with orjson if it is installed."""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def cache_key(url):
+    """Normalizes url so the same request always has the same cache key, whatever order the query is in."""
+    parts = urlsplit(url.strip())
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    normalized = urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    '''
+    An on-disk cache of DLG API JSON responses and resolved redirects, so repeat
+    exports of the same collections don't request them from the DLG again.
+    Each entry is a small JSON file named by its normalized URL. Entries older than
+    ttl seconds are ignored, and once the cache is bigger than max_size bytes the
+    least recently used entries are deleted.
+    '''
+
+    def __init__(self, cache_dir, ttl=24 * 60 * 60, max_size=500 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+
+    def path(self, url, kind):
+        return os.path.join(self.cache_dir, kind + '_' + cache_key(url) + '.json')
+
+    def get(self, url, kind='api'):
+        """Returns the cached value for url, or None if it is not cached or has expired."""
+        path = self.path(url, kind)
+        try:
+            with open(path, 'rb') as entry:
+                cached = loads(entry.read())
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - cached['saved'] > self.ttl:
+            return None
+
+        # Updating the modified time marks the entry as recently used for eviction.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return cached['value']
+
+    def put(self, url, value, kind='api'):
+        """Saves value for url, then evicts the least recently used entries if the cache is too big."""
+        path = self.path(url, kind)
+        text = json.dumps({'url': url, 'saved': time.time(), 'value': value})
+        with self.lock:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            temp_path = path + '.' + str(threading.get_ident()) + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as entry:
+                entry.write(text)
+            os.replace(temp_path, path)
+            self.size += os.path.getsize(path) - old_size
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache is at 90% of max_size."""
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_file()]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        self.size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.size -= size
+            except OSError:
+                pass
+
+
+class RateLimiter:
+    '''
+    Spaces out the requests to one host. Starts with no delay, backs off whenever the
+    host answers 429 Too Many Requests, and speeds back up while requests succeed.
+    '''
+
+    def __init__(self, max_interval=30):
+        self.interval = 0
+        self.max_interval = max_interval
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Sleeps until this request's turn, based on the current interval between requests."""
+        with self.lock:
+            now = time.monotonic()
+            turn = max(now, self.next_time)
+            self.next_time = turn + self.interval
+        if turn > now:
+            time.sleep(turn - now)
+
+    def throttle(self, retry_after=None):
+        """Slows down after a 429, waiting at least retry_after seconds if the host said how long."""
+        with self.lock:
+            self.interval = min(self.max_interval, max(self.interval * 2, 0.1))
+            if retry_after:
+                self.next_time = max(self.next_time, time.monotonic() + retry_after)
+
+    def succeed(self):
+        """Speeds back up a little after a successful request."""
+        with self.lock:
+            self.interval = self.interval * 0.9 if self.interval > 0.01 else 0
+
+
+def retry_after_seconds(response):
+    """Returns how many seconds the Retry-After header asks to wait, or None if it is missing or unreadable."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class Cancelled(BaseException):
+    '''
+    Raised by DLGClient once cancel() has been called, from the request that was
+    about to be made. It is a BaseException, like KeyboardInterrupt, so the places
+    that skip a page or link that failed to download let it through and the run stops.
+    '''
+
+
+class DLGClient:
+    '''
+    The one place all requests to the DLG go through. Uses a single session so
+    connections are kept alive and pooled per host, retries server errors and
+    timeouts with exponential backoff, honors Retry-After, throttles each host
+    that answers 429, and uses the ResponseCache when one is given. No more than
+    pool_size requests are in flight at once, however many threads share the client.
+    Keeps the latency, retry counts and bytes downloaded for each host, and how
+    many responses came from the cache, for report() and summary(). Once cancel()
+    is called, every request raises Cancelled, including ones waiting to retry.
+    '''
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size=4, retries=4, backoff=0.5, timeout=30, cache=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=max(10, pool_size))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max(1, pool_size))
+        self.limiters = {}
+        self.stats = {}
+        self.cache_hits = {'api': 0, 'redirect': 0}
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        """Stops the run using this client: every request from now on raises Cancelled."""
+        self.cancelled.set()
+
+    def check(self):
+        """Raises Cancelled if cancel() has been called."""
+        if self.cancelled.is_set():
+            raise Cancelled()
+
+    def host_state(self, url):
+        """Returns the rate limiter and stats dictionary for the host of url."""
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = RateLimiter()
+                self.stats[host] = {'requests': 0, 'retries': 0, 'throttled': 0, 'failures': 0, 'seconds': 0.0,
+                                    'slowest': 0.0, 'bytes': 0}
+            return self.limiters[host], self.stats[host]
+
+    def request(self, method, url, **kwargs):
+        '''
+        Makes the request, retrying server errors, 429s and timeouts up to self.retries times.
+        Returns the last response, or raises the last exception if the request never got one.
+        '''
+        import requests
+        limiter, stats = self.host_state(url)
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            self.check()
+            limiter.wait()
+
+            #Only the request itself is timed, not the wait for a free slot, so the latency is the server's
+            with self.slots:
+                start = time.monotonic()
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                    error = None
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    response = None
+                    error = e
+                seconds = time.monotonic() - start
+
+            with self.lock:
+                stats['requests'] += 1
+                stats['seconds'] += seconds
+                stats['slowest'] = max(stats['slowest'], seconds)
+
+            if response is not None and response.status_code not in self.RETRY_STATUS:
+                limiter.succeed()
+                return response
+
+            retry_after = retry_after_seconds(response) if response is not None else None
+            if response is not None and response.status_code == 429:
+                limiter.throttle(retry_after)
+                with self.lock:
+                    stats['throttled'] += 1
+
+            if attempt == self.retries:
+                break
+
+            with self.lock:
+                stats['retries'] += 1
+            if response is not None:
+                response.close()
+            # Waits to retry, but stops waiting as soon as the run is cancelled.
+            self.cancelled.wait(retry_after if retry_after is not None else self.backoff * 2 ** attempt)
+
+        with self.lock:
+            stats['failures'] += 1
+        if error is not None:
+            raise error
+        return response
+
+    def get_json(self, api_url):
+        """Returns the JSON response for api_url, from the cache if it has it."""
+        self.check()
+        if self.cache is not None:
+            json_dict = self.cache.get(api_url)
+            if json_dict is not None:
+                with self.lock:
+                    self.cache_hits['api'] += 1
+                return json_dict
+
+        response = self.request('GET', api_url)
+        response.raise_for_status()
+        json_dict = loads(response.content)
+        _, stats = self.host_state(api_url)
+        with self.lock:
+            stats['bytes'] += len(response.content)
+        if self.cache is not None:
+            self.cache.put(api_url, json_dict)
+        return json_dict
+
+    def resolve(self, url):
+        '''
+        Returns where url ends up after following its redirects. A HEAD request is used
+        so the file itself is never downloaded. If the server rejects HEAD, falls back to
+        a GET that stops after the headers and reads none of the body. Raises an
+        HTTPError if that fails too, so a link that could not be followed is never cached.
+        '''
+        self.check()
+        if self.cache is not None:
+            redirected = self.cache.get(url, 'redirect')
+            if redirected is not None:
+                with self.lock:
+                    self.cache_hits['redirect'] += 1
+                return redirected
+
+        response = self.request('HEAD', url, allow_redirects=True)
+        if response.status_code >= 400:
+            with self.request('GET', url, allow_redirects=True, stream=True) as response:
+                response.raise_for_status()
+
+        if self.cache is not None:
+            self.cache.put(url, response.url, 'redirect')
+        return response.url
+
+    def report(self):
+        """Returns a line for each host with its number of requests, latency and retries."""
+        lines = []
+        with self.lock:
+            for host, stats in sorted(self.stats.items()):
+                average = stats['seconds'] / stats['requests'] * 1000 if stats['requests'] else 0
+                lines.append(f"{host}: {stats['requests']} requests, {average:.0f} ms average, "
+                             f"{stats['slowest'] * 1000:.0f} ms slowest, {stats['retries']} retries, "
+                             f"{stats['throttled']} throttled (429), {stats['failures']} failed, "
+                             f"{stats['bytes'] / 1024:.0f} KB")
+        return lines
+
+    def summary(self):
+        """Returns the request counts, bytes downloaded and cache hits, in total and for each host."""
+        with self.lock:
+            hosts = {host: dict(stats) for host, stats in self.stats.items()}
+            cache_hits = dict(self.cache_hits)
+        totals = {key: sum(stats[key] for stats in hosts.values())
+                  for key in ('requests', 'retries', 'throttled', 'failures', 'bytes')}
+        return {**totals, 'cache_hits': cache_hits, 'hosts': hosts}
+
+
+class RunReport:
+    '''
+    Instrumentation for one run: the wall time spent in each stage, how many pages
+    and items are done, and a tally of each kind of error. Calls progress(report)
+    each time a page is done, so it can drive a progress display, and passes error
+    messages on to log. save() writes it all, with the client's request counts, as
+    a JSON report.
+    '''
+
+    STAGES = ('fetch', 'pagination', 'flatten', 'redirects', 'mapping', 'write')
+
+    def __init__(self, progress=None, log=print):
+        self.progress = progress
+        self.log = log
+        self.start = time.monotonic()
+        self.seconds = dict.fromkeys(self.STAGES, 0.0)
+        self.errors = {}
+        self.pages_total = 0
+        self.pages_done = 0
+        self.items = 0
+
+    @contextmanager
+    def stage(self, name):
+        """Adds the time spent in the with block to the stage name."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.monotonic() - start
+
+    def timed(self, name, iterable):
+        """Yields from iterable, adding the time spent waiting for each value to the stage name."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    value = next(iterator)
+                except StopIteration:
+                    return
+            yield value
+
+    def error(self, kind, message):
+        """Counts an error of kind and logs its message."""
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+        self.log(message)
+
+    def add_pages(self, pages):
+        """Adds to the number of pages to grab, as they become known."""
+        self.pages_total += pages
+
+    def page_done(self, items):
+        """Records a finished page with items items on it and updates the progress display."""
+        self.pages_done += 1
+        self.items += items
+        if self.progress is not None:
+            self.progress(self)
+
+    def status(self):
+        """Returns a line about how far along the run is."""
+        return '{} of {} pages, {} items, {:.1f} s'.format(self.pages_done, self.pages_total, self.items,
+                                                          time.monotonic() - self.start)
+
+    def summary(self):
+        """Returns the time for the whole run and each stage, the pages and items done, and the error tallies."""
+        return {'seconds': round(time.monotonic() - self.start, 3),
+                'stages': {name: round(seconds, 3) for name, seconds in self.seconds.items()},
+                'pages': self.pages_done, 'pages_total': self.pages_total, 'items': self.items,
+                'errors': dict(self.errors)}
+
+    def save(self, path, client=None):
+        """Writes the report as JSON to path, with the request counts from client if it is given."""
+        report = self.summary()
+        if client is not None:
+            report['requests'] = client.summary()
+        with open(path, 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+def progress_bar(report, width=30):
+    """Draws the progress of report as a bar on one line of the terminal."""
+    done = width * report.pages_done // report.pages_total if report.pages_total else 0
+    sys.stderr.write('\r[' + '#' * done + '.' * (width - done) + '] ' + report.status())
+    sys.stderr.flush()
+
+
+def page_url(api_url, page):
+    """Returns the api_url for the given page number of a search result."""
+    page_str = 'page=' + str(page)
+    #Only a page parameter of its own, not the end of another one like per_page
+    if type(re.search(r'(?<=[?&])page=\d+', api_url)) == re.Match:
+        return re.sub(r'(?<=[?&])page=\d+', page_str, api_url)
+
+    # The first page of a search doesn't have 'page=\d' yet.
+    if '?' not in api_url:
+        return api_url + '?' + page_str
+    return re.sub(r'\?', '?' + page_str + '&', api_url, count=1)
+
+
+def set_query(api_url, key, value):
+    """Returns api_url with key in its query set to value, replacing it if it is already there."""
+    parts = urlsplit(api_url)
+    query = [(name, old) for name, old in parse_qsl(parts.query, keep_blank_values=True) if name != key]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query + [(key, str(value))]), ''))
+
+
+def fetch_urls(keyed_urls, client, workers=4):
+    '''
+    Grabs the API URLs in keyed_urls, pairs of (key, api_url), at the same time,
+    with no more than workers requests in flight. Yields (key, json_dict) in the
+    same order as soon as each one is ready, and only asks for a few URLs ahead of
+    the one being used so the responses don't pile up in memory. json_dict is None
+    for any URL that could not be grabbed, so the caller can report it.
+    '''
+    def fetch(key, api_url):
+        try:
+            return key, client.get_json(api_url)
+        except Exception:
+            return key, None
+
+    workers = max(1, workers)
+    keyed_urls = iter(keyed_urls)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque(executor.submit(fetch, *keyed_url) for keyed_url in islice(keyed_urls, workers * 2))
+        while pending:
+            yield pending.popleft().result()
+            for keyed_url in islice(keyed_urls, 1):
+                pending.append(executor.submit(fetch, *keyed_url))
+
+
+def fetch_pages(api_url, pages, client, workers=4):
+    '''
+    Grabs the given pages of a search result at the same time, with no more than
+    workers requests in flight. Yields (page, json_dict) in page order, as fetch_urls does.
+    '''
+    return fetch_urls(((page, page_url(api_url, page)) for page in pages), client, workers)
+
+
+#The facets a large search can be split by, in the order they are tried
+SHARD_FACETS = ('year_facet', 'counties_facet', 'collection_titles_sms')
+
+
+def plan_shards(api_url, json_dict, shard_pages, facets=SHARD_FACETS):
+    '''
+    Returns a list of (name, shard_url) to harvest a large search result by instead
+    of walking its pages: api_url filtered to each value of the first facet in
+    facets whose counts on the first page in json_dict add up to at least the whole
+    search. Since an item can have several values of a facet, that does not prove
+    every item is in a shard, so iter_shards checks once they are grabbed. The
+    shards can all be grabbed at the same time, but are not split again, so a shard
+    can still have more than shard_pages pages. Returns None if the search has
+    shard_pages pages or fewer (or shard_pages is 0), or if no facet adds up.
+    '''
+    pages = json_dict['response']['pages']
+    if not shard_pages or pages['total_pages'] <= shard_pages or 'total_count' not in pages:
+        return None
+
+    facet_items = {facet['name']: facet.get('items', []) for facet in json_dict['response'].get('facets', [])}
+    for facet in facets:
+        items = facet_items.get(facet)
+
+        #If the counts add up to less than the whole search, the facet list was cut short or some items don't have it
+        if not items or sum(item['hits'] for item in items) < pages['total_count']:
+            continue
+
+        parts = urlsplit(api_url)
+        shards = []
+        for item in sorted(items, key=lambda item: str(item['value'])):
+            query = parse_qsl(parts.query, keep_blank_values=True) + [('f[{}][]'.format(facet), str(item['value']))]
+            shards.append(('{}={}'.format(facet, item['value']),
+                           urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))))
+        return shards
+    return None
+
+
+def thumbnail_url(item_id):
+    """Builds the DLG thumbnail URL for an item from its id, for items without a link to the file."""
+    repo_id, collection_id, item_id = item_id.split('_', 2)
+    return 'https://dlg.galileo.usg.edu/' + repo_id + '/' + collection_id + '/do-th:' + item_id
+
+
+def resolve_redirects(urls, client, workers=4):
+    '''
+    Resolves the redirects for every distinct URL in urls once, with no more than
+    workers requests in flight. Returns a dictionary of URL to redirected URL, where
+    the redirected URL is None if it could not be resolved.
+    '''
+    def resolve(url):
+        try:
+            return url, client.resolve(url)
+        except Exception:
+            return url, None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return dict(executor.map(resolve, set(urls)))
+
+
+def to_api_url(url):
+    '''
+    Returns the API URL for a URL from the DLG website, and if it is a search
+    result (True) or a single item (False).
+    '''
+    #Check for .json already in URL before we assume it is not there.
+    is_api_url = type(re.search('.json',url)) == re.Match
+
+    #Checking to see if url is a search result or a single item.
+    is_search_result = type(re.search('\?',url)) == re.Match
+
+    if not is_api_url:
+        #If this is reached, then '.json' is not present and
+        #we need to add it to the url to grab API response.
+        if is_search_result:
+            return re.sub('\?','.json?',url), is_search_result
+        return re.sub('$','.json',url), is_search_result
+
+    #If this is reached, then the URL is already the API response.
+    return url, is_search_result
+
+
+def normalize_url(url):
+    '''
+    Returns the API URL for a URL from the DLG website in one standard form, and if
+    it is a search result. The same search always gives the same URL whether it was
+    copied from the website or the API, whatever order the query is in, and whatever
+    page it was on, so identical searches are only grabbed once.
+    '''
+    api_url, is_search_result = to_api_url(url.strip())
+    parts = urlsplit(api_url)
+    query = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if key != 'page')
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), '')), is_search_result
+
+
+def unique_urls(url_list):
+    """Returns url_list without blank lines or URLs for the same search or item as an earlier URL."""
+    unique = {}
     for url in url_list:
+        if url.strip():
+            unique.setdefault(normalize_url(url)[0], url)
+    if len(unique) < len([url for url in url_list if url.strip()]):
+        print('Skipped {} URLs that were the same as an earlier URL.'.format(
+            len([url for url in url_list if url.strip()]) - len(unique)))
+    return list(unique.values())
 
-        #Check for .json already in URL before we assume it is not there.
-        is_api_url = type(re.search('.json',url)) == re.Match
 
-        #Checking to see if url is a search result or a single item.
-        is_search_result = type(re.search('\?',url)) == re.Match
-        url_old = url
+class RecordIndex:
+    '''
+    The ids of every item grabbed so far, so an item that is in more than one search
+    is only kept the first time, before any more work is done on it. Counts how many
+    duplicates each input URL had.
+    '''
 
-        if not is_api_url:
-            #If this is reached, then '.json' is not present and
-            #we need to add it to the url to grab API response.
-            if is_search_result:
-                api_url = re.sub('\?','.json?',url)
+    def __init__(self):
+        self.ids = set()
+        self.duplicates = {}
 
-            else:
-                api_url = re.sub('$','.json',url)
+    def is_new(self, url, item_id):
+        """Returns True if item_id has not been seen before, and records it as seen."""
+        if item_id in self.ids:
+            self.duplicates[url] = self.duplicates.get(url, 0) + 1
+            return False
+        self.ids.add(item_id)
+        return True
+
+    def new(self, url, docs):
+        """Returns the docs that have not been seen before, and records them as seen."""
+        return [item for item in docs if self.is_new(url, item['id'])]
+
+    def report(self):
+        """Returns a line for each input URL that had duplicate items."""
+        return ['{}: {} duplicate items skipped'.format(url, count) for url, count in self.duplicates.items()]
+
+
+def iter_shards(url, api_url, json_dict, shards, finished, client, workers=4, report=None, seen=None):
+    '''
+    Yields (url, page, total_pages, docs) for every page of the shards of url, from
+    plan_shards, skipping the pages in finished. The first page of every shard is
+    grabbed at the same time, to know how many pages there are in all, and then
+    the rest of the pages of every shard are. Each page is named by its shard and
+    page number, like "year_facet=1920:2", so a resumed harvest can tell which
+    pages it already has. An item in more than one shard is kept once by the caller.
+
+    If the shards had fewer items than the whole search, whose first page from
+    api_url is json_dict, some items have no value for the facet. Then the whole
+    search is walked as well, with its pages named like "all:2", so the caller's
+    RecordIndex keeps just the missing items. When a harvest is resumed, seen is the
+    set of ids on the pages of url it already finished, which count towards the shards.
+    '''
+    if report is None:
+        report = RunReport()
+    ids = set(seen or ())
+    first_pages = []
+    for (name, shard_url), shard_json in report.timed('pagination', fetch_urls(
+            (((name, shard_url), page_url(shard_url, 1)) for name, shard_url in shards), client, workers)):
+        if shard_json is None:
+            report.error('page', 'Something happened on page 1 of this part of the search: {}'.format(
+                re.sub(r'\.json','',page_url(shard_url, 1))))
+        first_pages.append((name, shard_url, shard_json))
+
+    #A shard whose first page failed counts as one page, which is never finished
+    total_pages = sum(shard_json['response']['pages']['total_pages'] if shard_json else 1
+                      for name, shard_url, shard_json in first_pages)
+    report.add_pages(total_pages - len([page for page in finished if not page.startswith('all:')]))
+
+    remaining = []
+    for name, shard_url, shard_json in first_pages:
+        if shard_json is None:
+            continue
+        if name + ':1' not in finished:
+            ids.update(item['id'] for item in shard_json['response']['docs'])
+            yield url, name + ':1', total_pages, shard_json['response']['docs']
+        remaining.extend(((name, page), page_url(shard_url, page))
+                         for page in range(2, shard_json['response']['pages']['total_pages'] + 1)
+                         if '{}:{}'.format(name, page) not in finished)
+    del first_pages
+
+    for (name, page), shard_json in report.timed('pagination', fetch_urls(remaining, client, workers)):
+        if shard_json is None:
+            report.error('page', 'Something happened on page {} of this part of the search: {}'.format(page, name))
+            continue
+        ids.update(item['id'] for item in shard_json['response']['docs'])
+        yield url, '{}:{}'.format(name, page), total_pages, shard_json['response']['docs']
+
+    total_count = json_dict['response']['pages']['total_count']
+    walked = any(page.startswith('all:') for page in finished)
+    if not walked and len(ids) >= total_count:
+        return
+    if not walked:
+        report.error('shard', 'The smaller searches for {} only had {} of its {} items, so the whole search will '
+                              'be grabbed as well.'.format(url, len(ids), total_count))
+
+    #The whole search, counted after the shards, so a resumed harvest knows it is not finished until it is walked
+    search_pages = json_dict['response']['pages']['total_pages']
+    total_pages += search_pages
+    report.add_pages(search_pages - len([page for page in finished if page.startswith('all:')]))
+    if 'all:1' not in finished:
+        yield url, 'all:1', total_pages, json_dict['response']['docs']
+    remaining = [page for page in range(2, search_pages + 1) if 'all:{}'.format(page) not in finished]
+    for page, page_json in report.timed('pagination', fetch_pages(api_url, remaining, client, workers)):
+        if page_json is None:
+            report.error('page', 'Something happened on page {} of this URL: {}'.format(
+                page, re.sub(r'\.json','',page_url(api_url, page))))
+            continue
+        yield url, 'all:{}'.format(page), total_pages, page_json['response']['docs']
+
+
+def iter_pages(url_list, client, workers=4, done=None, report=None, shard_pages=0, per_page=0, seen=None):
+    '''
+    Yields (url, page, total_pages, docs) for every page of items from the DLG API
+    for the URLs in url_list, in order. A single item is page 1 of 1. Pages of a
+    search result are yielded as they arrive, so the whole harvest is never held in
+    memory. done is an optional dictionary of url to (total_pages, set of pages)
+    that are already finished, which are skipped. The time spent grabbing pages, the
+    number of pages and any errors are recorded in report, a RunReport, and notes
+    about how a search is being grabbed are passed to its log.
+
+    A search with more than shard_pages pages is split into smaller searches by
+    plan_shards and harvested with iter_shards instead, if it can be. seen is an
+    optional dictionary of url to the ids on its finished pages, for iter_shards.
+
+    If per_page is given, searches ask for that many items on each page instead of
+    the DLG's default, so fewer pages are needed. If the first page has fewer items
+    than that but is not the last page, the DLG has a smaller largest page size, so
+    the rest of the pages ask for that size and are counted again from it.
+    '''
+    done = done or {}
+    seen = seen or {}
+    if report is None:
+        report = RunReport()
+    for url in url_list:
+        api_url, is_search_result = normalize_url(url)
+        if is_search_result and per_page:
+            api_url = set_query(api_url, 'per_page', per_page)
+        total_pages, finished = done.get(url, (None, set()))
+
+        #Everything for this URL was already finished. Shards that are all finished still need their items
+        #counted against the whole search, unless it was already being walked.
+        sharded = any(isinstance(page, str) for page in finished)
+        walked = any(str(page).startswith('all:') for page in finished)
+        if total_pages is not None and len(finished) >= total_pages and (walked or not sharded):
+            continue
+
+        #Grabbing the response json. Not needed if the first page was already finished,
+        #since the total pages are known.
+        if 1 not in finished:
+            try:
+                #The error check was important because of the older version,
+                #but I will keep it just incase. Now that I implenmented reading
+                #reading the urls from the file istead of the command line,
+                #majority of the potential errors have been alleviated.
+
+                with report.stage('fetch'):
+                    json_dict = client.get_json(api_url)
+
+            except Exception:
+                report.error('url', 'Something went wrong with the url\n'
+                             '{} is the url you are trying to parse.'.format(url))
+                continue
+
+            if not is_search_result:
+                report.add_pages(1)
+                yield url, 1, 1, [json_dict['response']['document']]
+                continue
+
+            #The largest page size the DLG will give, if it is smaller than the one asked for.
+            pages = json_dict['response']['pages']
+            page_size = len(json_dict['response']['docs'])
+            if per_page and 0 < page_size < per_page and pages['total_pages'] > 1:
+                report.log('The DLG only gives {} items a page, so that is what will be asked for.'.format(
+                    page_size))
+                api_url = set_query(api_url, 'per_page', page_size)
+                if 'total_count' in pages:
+                    pages['total_pages'] = -(-pages['total_count'] // page_size)
+
+            #A very large search is grabbed in shallow parts instead of page by page.
+            shards = plan_shards(api_url, json_dict, shard_pages)
+            if shards is not None:
+                report.log('Splitting {} into {} smaller searches.'.format(url, len(shards)))
+                yield from iter_shards(url, api_url, json_dict, shards, finished, client, workers, report,
+                                       seen.get(url))
+                continue
+
+            #If the URL is a search query, then we need to grab every item on
+            #every page.
+            total_pages = json_dict['response']['pages']['total_pages']
+            report.add_pages(total_pages - len(finished))
+
+            # The results from the first page of the API call.
+            yield url, 1, total_pages, json_dict['response']['docs']
         else:
-            #If this is reached, then the URL is already the API response.
-            api_url = url
+            report.add_pages(total_pages - len(finished))
+
+        # If there are multiple pages, grabs all the other pages at once and yields them in page order.
+        remaining = [page for page in range(2, total_pages + 1) if page not in finished]
+        for page, json_dict in report.timed('pagination', fetch_pages(api_url, remaining, client, workers)):
+            if json_dict is None:
+                report.error('page', 'Something happened on page {} of this URL: {}'.format(
+                    page, re.sub('\.json','',page_url(api_url, page))))
+                continue
+            yield url, page, total_pages, json_dict['response']['docs']
+
+
+def to_row(item, new_column_name, separator=', ', log=print):
+    '''
+    Returns the CSV row for item in one pass: only the fields in the mapping are
+    kept, renamed to their mapped column names, and each list is joined into one
+    string with separator so the excess qoutation marks and brackets go away.
+    Fields that are not in the mapping are never looked at. Plus we will handle the
+    copyright issues by replacing the item with the thumbnails.
+    '''
+    row = {}
+    for key, column in new_column_name.items():
+        if key not in item:
+            continue
+        value = item[key]
 
+        #Changing the list into one big string
+        if type(value) == list:
+            try:
+                value = separator.join(value)
+            except TypeError:
+                value = separator.join(map(str, value))
 
+        #Thumbnails
+        elif key == 'edm_is_shown_by' and value == None:
+            try:
+                value = thumbnail_url(item['id'])
+            except:
+                log(item.get('id'))
 
-        #Grabbing the response json
+        row[column] = value
+    return row
+
+
+def resolve_item_urls(rows, client, workers=4, column='File', log=print):
+    '''
+    Changes the item URLs in column to where they redirect. Each distinct URL is only
+    resolved once. Returns the dictionary of URL to redirected URL.
+    '''
+    if column is None:
+        return {}
+    shown_by = [row[column] for row in rows if row.get(column)]
+    redirects = resolve_redirects(shown_by, client, workers)
+    for row in rows:
+        if row.get(column):
+            if redirects[row[column]] is None:
+                log(row[column])
+            else:
+                row[column] = redirects[row[column]]
+    return redirects
+
+
+class RawWriter:
+    '''
+    Saves the DLG's responses as they are harvested, so the CSV can be made again
+    later, for example with a different mapping, without requesting anything. The
+    file is gzipped JSON Lines: a line for each page, with its input URL, page and
+    docs, and a line for each set of resolved item URL redirects. If append is True
+    the lines are added to the end of an existing file, for a resumed harvest.
+    '''
+
+    def __init__(self, path, append=False):
+        if append and os.path.exists(path):
+            #A harvest that was killed can leave the end of the file cut off, and nothing added after that could be
+            #read, so the lines that can be read are copied to a new file first, which is only used once it is done
+            copy_path = path + '.copy'
+            with gzip.open(copy_path, 'wt', encoding='utf-8') as copy:
+                for line in read_raw_lines([path]):
+                    copy.write(line)
+            os.replace(copy_path, path)
+        self.file = gzip.open(path, 'at' if append else 'wt', encoding='utf-8')
+
+    def page(self, url, page, docs):
+        self.file.write(json.dumps({'url': url, 'page': page, 'docs': docs}) + '\n')
+
+    def redirects(self, redirects):
+        """Saves the redirects that were resolved."""
+        resolved = {url: redirected for url, redirected in redirects.items() if redirected is not None}
+        if resolved:
+            self.file.write(json.dumps({'redirects': resolved}) + '\n')
+
+    def flush(self):
+        """Saves everything written so far to disk, so it can be read even if the harvest is killed."""
+        self.file.flush()
+        os.fsync(self.file.buffer.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def read_raw_lines(raw_files):
+    '''
+    Yields the lines of the raw files saved by RawWriter, streaming them so they are
+    never all in memory. A file that was cut off, by a harvest that was stopped, is
+    read up to where it ends, leaving out a last line that is not all there.
+    '''
+    for raw_file in raw_files:
         try:
-            #The error check was important because of the older version,
-            #but I will keep it just incase. Now that I implenmented reading
-            #reading the urls from the file istead of the command line,
-            #majority of the potential errors have been alleviated.
+            with gzip.open(raw_file, 'rt', encoding='utf-8') as raw:
+                for line in raw:
+                    if line.endswith('\n'):
+                        yield line
+        except (EOFError, gzip.BadGzipFile, zlib.error):
+            print('The end of {} is cut off, so it was only read up to there.'.format(raw_file))
 
-            response = requests.get(api_url)
-            json_dict = response.json()
 
-        except:
-            print('Something went wrong with the url')
-            print('{} is the url you are trying to parse.'.format(url_old))
+def decode_raw_lines(lines, new_column_name, separator=', '):
+    '''
+    Decodes lines from a raw file and turns their docs into rows. Returns a list of
+    (url, list of (id, row)) for each page, the redirects, and a list of (kind,
+    message) for any problems. Runs in another process when replaying in parallel.
+    '''
+    pages = []
+    redirects = {}
+    errors = []
+    for line in lines:
+        try:
+            entry = loads(line)
+        except ValueError:
+            errors.append(('raw', 'A line of the raw file could not be read and was skipped.'))
+            continue
+        if 'redirects' in entry:
+            redirects.update(entry['redirects'])
             continue
+        pages.append((entry['url'], [(item['id'], to_row(item, new_column_name, separator,
+                                                         lambda item_id: errors.append(('thumbnail', item_id))))
+                                     for item in entry['docs']]))
+    return pages, redirects, errors
 
-        json_dict = response.json()
 
-        if not is_search_result:
-            list_json.append(json_dict['response']['document'])
-        else:
-            #If the URL is a search query, then we need to grab every item on
-            #every page. This entire else statement handles that.
+def replay_raw(raw_files, new_column_name, separator=', ', processes=1, index=None, report=None, chunk_lines=20):
+    '''
+    Returns the CSV rows for every item in raw_files, saved by RawWriter, like
+    dlg_json2list but with no requests: the saved pages are flattened and mapped with
+    new_column_name, and the saved redirects are used for the item URLs. The files
+    are streamed chunk_lines lines at a time, and if processes is more than 1 the
+    chunks are decoded by that many processes at the same time.
+    '''
+    if index is None:
+        index = RecordIndex()
+    if report is None:
+        report = RunReport()
 
-            total_pages = json_dict['response']['pages']['total_pages']
+    lines = read_raw_lines(raw_files)
+    chunks = iter(lambda: list(islice(lines, chunk_lines)), [])
+
+    def decoded():
+        if processes <= 1:
+            for chunk in chunks:
+                yield decode_raw_lines(chunk, new_column_name, separator)
+            return
+
+        #Only a few chunks ahead are decoded, so the results don't pile up in memory
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            pending = deque(executor.submit(decode_raw_lines, chunk, new_column_name, separator)
+                            for chunk in islice(chunks, processes * 2))
+            while pending:
+                yield pending.popleft().result()
+                for chunk in islice(chunks, 1):
+                    pending.append(executor.submit(decode_raw_lines, chunk, new_column_name, separator))
+
+    rows = []
+    redirects = {}
+    for pages, chunk_redirects, errors in report.timed('flatten', decoded()):
+        redirects.update(chunk_redirects)
+        for kind, message in errors:
+            report.error(kind, message)
+        for url, items in pages:
+            page_rows = [row for item_id, row in items if index.is_new(url, item_id)]
+            rows.extend(page_rows)
+            report.add_pages(1)
+            report.page_done(len(page_rows))
 
-            # Saves the results from the first page of the API call to the list.
-            for item in json_dict['response']['docs']:
-                list_json.append(item)
+    #Item URLs that were not redirected when the harvest was saved are left as they are
+    column = new_column_name.get('edm_is_shown_by')
+    with report.stage('redirects'):
+        if column is not None:
+            for row in rows:
+                if row.get(column) in redirects:
+                    row[column] = redirects[row[column]]
+    return rows
 
-            # If there are multiple pages, calculates the api_url for all the other pages and adds them to the list.
-            # Stops when the total number of pages is reached.
-            if total_pages > 1:
 
-                # Range produces a sequence of numbers from 2 - last page number.
-                for page in range(2, total_pages + 1):
+def dlg_json2list(url_list, new_column_name, workers=4, client=None, index=None, separator=', ', report=None,
+                  shard_pages=0, per_page=0, raw=None):
+    '''
+    Returns the CSV rows for every item from the DLG API for the URLs in url_list,
+    with the fields in new_column_name renamed to their mapped column names. The time
+    for each stage, progress and errors are recorded in report, a RunReport. Searches
+    with more than shard_pages pages are split up, and ask for per_page items on
+    each page, as in iter_pages. If raw, a RawWriter, is given, the pages and
+    redirects are saved to it.
+    '''
 
-                    # Create the api_url for the next page.
-                    page_str = 'page=' + str(page)
-                    if type(re.search(r'page=\d+', api_url)) == re.Match:
-                        api_url = re.sub(r'page=\d+', page_str, api_url)
-                    else:
-                        # For the first iteration, which doesn't have 'page=\d' yet.
-                        page_str = '?' + page_str + '&'
-                        api_url = re.sub(r'\?', page_str, api_url)
+    #All requests go through one client so connections are reused.
+    if client is None:
+        client = DLGClient(workers)
 
-                    # Grabbing the response and JSON for the new api_url.
-                    try:
-                        response = requests.get(api_url)
-                        json_dict = response.json()
-                    except:
-                        print('Something happened on page {} of this URL: {}'.format(page, re.sub('\.json','',api_url)))
+    #Items already grabbed from an earlier URL are skipped as soon as they arrive.
+    if index is None:
+        index = RecordIndex()
 
-                    # Saves the response to the list.
-                    for item in json_dict['response']['docs']:
-                        list_json.append(item)
+    if report is None:
+        report = RunReport()
 
+    #Each item is cut down to its row as soon as it arrives, so unmapped fields aren't kept,
+    #and only one page of the DLG's full JSON is in memory at a time.
+    rows = []
+    for url, page, total_pages, docs in iter_pages(url_list, client, workers, None, report, shard_pages, per_page):
+        if raw is not None:
+            raw.page(url, page, docs)
+        with report.stage('flatten'):
+            page_rows = [to_row(item, new_column_name, separator, lambda item_id: report.error('thumbnail', item_id))
+                         for item in index.new(url, docs)]
+        rows.extend(page_rows)
+        report.page_done(len(page_rows))
 
-    #Error Check. list_json should have 1 or more items inside. otherwise exit.
-    if len(list_json) < 1:
+    #Error Check. rows should have 1 or more items inside. otherwise exit.
+    if len(rows) < 1:
         print('Was not able to grab any of the URLs. Please check them.')
         sys.exit()
 
+    with report.stage('redirects'):
+        redirects = resolve_item_urls(rows, client, workers, new_column_name.get('edm_is_shown_by'),
+                                      lambda url: report.error('redirect', url))
+    if raw is not None:
+        raw.redirects(redirects)
+    return rows
+
+
+def load_mapping(dlg_mapping):
+    """Returns the DLG Dublin Core Mapping as a dictionary of DLG field name to column name."""
+    new_column_name = {}
+    with open(dlg_mapping,'r') as map_csv:
+        w = csv.reader(map_csv)
+        for row in w:
+            new_column_name.update({row[0]:row[1]})
+    return new_column_name
+
+
+class Journal:
+    '''
+    A checkpoint journal kept next to the output CSV while streaming, so an
+    interrupted harvest can be resumed. Each line is the JSON for one finished
+    (url, page): its total pages, the ids of its items, how many records it wrote,
+    the total written so far, and how long the CSV was once they were written.
+    '''
+
+    def __init__(self, csv_name):
+        self.path = csv_name + '.journal'
+
+    def load(self):
+        '''
+        Returns (done, ids, written, offset): a dictionary of url to (total_pages, set
+        of finished pages), a dictionary of url to the ids of the items on its finished
+        pages, the number of records written, and the length of the CSV when the last
+        page was finished.
+        A partly written last line is ignored.
+        '''
+        done = {}
+        ids = {}
+        written = 0
+        offset = None
+        if not os.path.exists(self.path):
+            return done, ids, written, offset
+
+        with open(self.path, 'r', encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                #A sharded search that had to be walked as well has more pages than it first recorded
+                total, pages = done.get(entry['url'], (0, set()))
+                pages.add(entry['page'])
+                done[entry['url']] = (max(total, entry['total_pages']), pages)
+                ids.setdefault(entry['url'], set()).update(entry['ids'])
+                written = entry['written']
+                offset = entry['offset']
+        return done, ids, written, offset
+
+    def start(self):
+        """Opens the journal for adding finished pages."""
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def record(self, url, page, total_pages, ids, records, written, offset):
+        """Adds a finished page, which is saved to disk before moving on."""
+        self.file.write(json.dumps({'url': url, 'page': page, 'total_pages': total_pages, 'ids': ids,
+                                    'records': records, 'written': written, 'offset': offset}) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self, finished):
+        """Closes the journal, and deletes it if the whole harvest finished so there is nothing to resume."""
+        self.file.close()
+        if finished:
+            os.remove(self.path)
+
+
+class ExportState:
+    '''
+    The ids and last-seen versions of the items from earlier exports, for
+    incremental exports that only write new or changed items. An item's version is
+    its updated_at timestamp, or a hash of its JSON if the API does not give one.
+    Saved as a JSON file of id to version.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.previous = {}
+        self.seen = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as state_file:
+                self.previous = json.load(state_file)
+
+    @staticmethod
+    def version(item):
+        """Returns the item's updated_at timestamp, or a hash of its JSON if it doesn't have one."""
+        if item.get('updated_at'):
+            return item['updated_at']
+        return hashlib.sha1(json.dumps(item, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def changed(self, item):
+        """Records the item as seen and returns True if it is new or changed since the last export."""
+        version = self.version(item)
+        self.seen[item['id']] = version
+        return self.previous.get(item['id']) != version
+
+    def deleted(self):
+        """Returns the ids from the last export that were not seen in this one."""
+        return sorted(set(self.previous) - set(self.seen))
+
+    def save(self, complete=True):
+        '''
+        Saves the versions seen in this export. If the export was not complete, items
+        from the last export that were not seen are kept instead of treated as deleted.
+        '''
+        state = self.seen if complete else {**self.previous, **self.seen}
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as state_file:
+            json.dump(state, state_file)
+        os.replace(temp_path, self.path)
+
+
+class CSVWriter:
+    '''
+    Writes rows to a CSV with the given columns. If append is True the rows are
+    added to the end of an existing CSV, which already has its header.
+    '''
+
+    resumable = True
+
+    def __init__(self, path, columns, encoding='utf-8', append=False):
+        self.file = open(path, 'a' if append else 'w', newline='', encoding=encoding)
+        self.writer = csv.DictWriter(self.file, fieldnames=columns)
+        if not append:
+            self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def tell(self):
+        """Saves what has been written and returns how long the file is, so a resume can cut it back to here."""
+        self.file.flush()
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class ChunkedCSVWriter:
+    '''
+    Writes rows to a series of CSVs with the given columns, starting a new one every
+    chunk_rows rows, so each can be uploaded to Omeka's CSV Import on its own. The
+    files are named after path with _001, _002 and so on before the extension.
+    '''
+
+    resumable = False
+
+    def __init__(self, path, columns, encoding='utf-8', chunk_rows=1000):
+        self.root, self.extension = os.path.splitext(path)
+        self.columns = columns
+        self.encoding = encoding
+        self.chunk_rows = chunk_rows
+        self.chunks = 0
+        self.rows = 0
+        self.writer = None
+
+    def write(self, rows):
+        for row in rows:
+            if self.writer is None or self.rows >= self.chunk_rows:
+                self.next_chunk()
+            self.writer.write([row])
+            self.rows += 1
+
+    def next_chunk(self):
+        """Closes the current CSV and starts the next one."""
+        if self.writer is not None:
+            self.writer.close()
+        self.chunks += 1
+        self.rows = 0
+        self.writer = CSVWriter('{}_{:03d}{}'.format(self.root, self.chunks, self.extension), self.columns,
+                                self.encoding)
+
+    def tell(self):
+        if self.writer is not None:
+            self.writer.tell()
+        return None
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class JSONLinesWriter:
+    '''
+    Writes rows to a JSON Lines file, one JSON object per row with its mapped
+    column names in the same order as the CSV. Columns with no data are left out.
+    '''
+
+    resumable = True
+
+    def __init__(self, path, columns, encoding='utf-8', append=False):
+        self.file = open(path, 'a' if append else 'w', encoding=encoding)
+        self.columns = columns
+
+    def write(self, rows):
+        for row in rows:
+            self.file.write(json.dumps({column: row[column] for column in self.columns if row.get(column) is not None},
+                                       ensure_ascii=False) + '\n')
+
+    def tell(self):
+        self.file.flush()
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    '''
+    Writes rows to a compressed Parquet file with a text column for each of the given
+    columns. Rows are written in row groups of row_group_size as they come in, so the
+    whole harvest is never held in memory. Needs pyarrow.
+    '''
+
+    resumable = False
+
+    def __init__(self, path, columns, row_group_size=10000, compression='snappy'):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            sys.exit('Writing Parquet needs pyarrow. Install it with: pip install pyarrow')
+        self.pyarrow = pyarrow
+        self.columns = columns
+        self.row_group_size = row_group_size
+        self.schema = pyarrow.schema([(column, pyarrow.string()) for column in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression=compression)
+        self.rows = []
+
+    def write(self, rows):
+        self.rows.extend(rows)
+        while len(self.rows) >= self.row_group_size:
+            self.write_group(self.rows[:self.row_group_size])
+            self.rows = self.rows[self.row_group_size:]
+
+    def write_group(self, rows):
+        """Writes rows as one row group."""
+        data = {column: [None if row.get(column) is None else str(row[column]) for row in rows]
+                for column in self.columns}
+        self.writer.write_table(self.pyarrow.Table.from_pydict(data, schema=self.schema))
+
+    def tell(self):
+        return None
+
+    def close(self):
+        if self.rows:
+            self.write_group(self.rows)
+            self.rows = []
+        self.writer.close()
+
+
+FORMATS = ('csv', 'jsonl', 'parquet')
+
+
+def writer_class(output_format, chunk_rows=0):
+    """Returns the class of writer for output_format, one of FORMATS. A CSV is split up if chunk_rows is more than 0."""
+    if output_format == 'parquet':
+        return ParquetWriter
+    if output_format == 'jsonl':
+        return JSONLinesWriter
+    if chunk_rows > 0:
+        return ChunkedCSVWriter
+    return CSVWriter
+
+
+def make_writer(output_format, path, columns, encoding='utf-8', append=False, chunk_rows=0):
+    '''
+    Returns the writer for output_format, one of FORMATS, writing rows with the given
+    columns to path. A CSV is split into files of chunk_rows rows if chunk_rows is
+    more than 0. append is only used by the writers that are resumable.
+    '''
+    writer = writer_class(output_format, chunk_rows)
+    if writer is ParquetWriter:
+        return ParquetWriter(path, columns)
+    if writer is ChunkedCSVWriter:
+        return ChunkedCSVWriter(path, columns, encoding, chunk_rows)
+    return writer(path, columns, encoding, append)
+
+
+def stream_csv(url_list, csv_name, new_column_name, client, workers=4, encoding='utf-8', resume=False, state=None,
+               deleted_name=None, index=None, separator=', ', report=None, output_format='csv', chunk_rows=0,
+               shard_pages=0, per_page=0, raw=None):
+    '''
+    Writes the CSV one page of items at a time as they are grabbed, instead of
+    building the whole harvest in memory first, so memory stays flat however many
+    items there are. The columns are every column in the mapping, in the same
+    alphabetical order as the regular CSV. output_format and chunk_rows choose the
+    writer, as in make_writer. Searches with more than shard_pages pages are split
+    up, and ask for per_page items on each page, as in iter_pages. A resumed harvest
+    needs the same per_page as the one it continues, since its pages are counted by it.
+    If raw, a RawWriter, is given, the pages and redirects are saved to it.
+
+    Each finished page is recorded in a Journal. If resume is True and there is a
+    journal from an earlier run, the pages it finished are skipped and the rest are
+    added to the end of the partial CSV. Only a single CSV or JSON Lines file can be
+    resumed; the others start over.
+
+    If state is an ExportState, only new or changed items are written (and have their
+    redirects resolved), and the state is saved at the end. If deleted_name is given
+    and every page was grabbed, the ids from the last export that are gone are written
+    to it, one per line.
+
+    Items already grabbed from an earlier URL, or an earlier run being resumed, are
+    skipped using index, a RecordIndex. The time for each stage, progress and errors
+    are recorded in report, a RunReport. Returns the number of rows in the CSV.
+    '''
+    if index is None:
+        index = RecordIndex()
+    if report is None:
+        report = RunReport()
+    journal = Journal(csv_name)
+    resume = resume and writer_class(output_format, chunk_rows).resumable
+    done, ids, written, offset = journal.load() if resume else ({}, {}, 0, None)
+    journal_done = {url: set(pages) for url, (total, pages) in done.items()} if offset is not None else {}
+
+    columns = sorted(set(new_column_name.values()))
+    if offset is not None and os.path.exists(csv_name):
+        for url_ids in ids.values():
+            index.ids.update(url_ids)
+
+        #Removing anything written after the last finished page, which would be repeated
+        os.truncate(csv_name, offset)
+        writer = make_writer(output_format, csv_name, columns, encoding, True, chunk_rows)
+    else:
+        done, ids, written = {}, {}, 0
+        if os.path.exists(journal.path):
+            os.remove(journal.path)
+        writer = make_writer(output_format, csv_name, columns, encoding, False, chunk_rows)
+
+    #Pages that could not be grabbed stay out of the journal, so a later resume tries them again
+    failed = False
+    journal.start()
+    try:
+        for url, page, total_pages, docs in iter_pages(url_list, client, workers, done, report, shard_pages,
+                                                       per_page, ids):
+            if raw is not None:
+                raw.page(url, page, docs)
+
+            #Every id on the page is recorded, even ones from an earlier URL, so a resumed sharded search can
+            #tell whether its shards had every item
+            page_ids = [item['id'] for item in docs]
+            docs = index.new(url, docs)
+            if state is not None:
+                #Unchanged items are dropped before any more work is done on them
+                docs = [item for item in docs if state.changed(item)]
+            with report.stage('flatten'):
+                rows = [to_row(item, new_column_name, separator, lambda item_id: report.error('thumbnail', item_id))
+                        for item in docs]
+            with report.stage('redirects'):
+                redirects = resolve_item_urls(rows, client, workers, new_column_name.get('edm_is_shown_by'),
+                                              lambda url: report.error('redirect', url))
+            if raw is not None:
+                raw.redirects(redirects)
+            with report.stage('write'):
+                writer.write(rows)
+                written += len(rows)
+
+                #The page has to be in the raw file before the journal says it is finished
+                if raw is not None:
+                    raw.flush()
+                journal.record(url, page, total_pages, page_ids, len(rows), written, writer.tell())
+            total, pages = done.get(url, (0, set()))
+            pages.add(page)
+            done[url] = (max(total, total_pages), pages)
+            report.page_done(len(rows))
+
+        failed = any(url not in done or len(done[url][1]) < done[url][0] for url in url_list)
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        writer.close()
+        journal.close(not failed)
+
+    #Items on pages finished before a resume were not seen by this run, so they can't count as deleted
+    if state is not None:
+        complete = not failed and not any(done_pages for total, done_pages in journal_done.values())
+        state.save(complete)
+        if deleted_name and complete:
+            with open(deleted_name, 'w', encoding='utf-8') as deleted_file:
+                for item_id in state.deleted():
+                    deleted_file.write(item_id + '\n')
+        elif deleted_name:
+            print('Deleted ids were not written because not every page was grabbed in this run.')
+    return written
+
+def read_urls(url_file):
+    """Returns the URLs in url_file, one per line, without the ones for the same search or item as an earlier URL."""
+    url_list = []
+    with open(url_file,'r') as dlg_urls:
+        for line in dlg_urls:
+            url_list.append(line.strip())
+
+    #The same search or item is only grabbed once, however it was written
+    return unique_urls(url_list)
+
+
+def export(url_file, csv_name, new_column_name, client, options, report=None):
+    '''
+    Makes one output file, csv_name, from the URLs in url_file, with the fields in
+    new_column_name. options are the command line arguments, and every request goes
+    through client. Returns the number of rows written and the RecordIndex of the
+    items that were grabbed.
+    '''
+    if report is None:
+        report = RunReport()
+    url_list = read_urls(url_file)
+    index = RecordIndex()
+
+    #Saving the DLG's responses, so the output can be made again later without requesting them
+    raw = RawWriter(options.save_raw, options.resume) if options.save_raw else None
+    try:
+        return harvest(url_list, csv_name, new_column_name, client, options, index, report, raw)
+    finally:
+        if raw is not None:
+            raw.close()
+
+
+def harvest(url_list, csv_name, new_column_name, client, options, index, report, raw=None):
+    """Grabs the items for url_list and writes them to csv_name, for export. Returns the same as export."""
+    if options.stream or options.resume or options.state:
+        if options.resume and not writer_class(options.format, options.chunk_rows).resumable:
+            print('Only a single CSV or JSON Lines file can be resumed, so the harvest will start over.')
+
+        #Writing each batch of items to the csv as soon as it is grabbed
+        state = ExportState(options.state) if options.state else None
+        written = stream_csv(url_list, csv_name, new_column_name, client, options.workers, options.encode,
+                             options.resume, state, options.deleted, index, options.separator, report, options.format,
+                             options.chunk_rows, options.shard_pages, options.per_page, raw)
+        if state is not None:
+            print('{} new or changed items were written.'.format(written))
+        elif written < 1:
+            print('Was not able to grab any of the URLs. Please check them.')
+        return written, index
+
+    #Grabbing the complete list of jsons from the provided URLs
+    rows = dlg_json2list(url_list, new_column_name, options.workers, client, index, options.separator, report,
+                         options.shard_pages, options.per_page, raw)
+    write_rows(rows, csv_name, options, report)
+    return len(rows), index
+
+
+def write_rows(rows, csv_name, options, report):
+    """Writes rows to csv_name in the format from options, with only the columns that have data."""
+    #The rows already have the mapped column names, so the only columns to set are the ones with data, in order
+    with report.stage('mapping'):
+        columns = sorted(set(column for row in rows for column in row))
+    with report.stage('write'):
+        writer = make_writer(options.format, csv_name, columns, options.encode, chunk_rows=options.chunk_rows)
+        writer.write(rows)
+        writer.close()
+
+
+def export_raw(raw_files, csv_name, new_column_name, options, report=None):
+    '''
+    Makes one output file, csv_name, from raw files saved with --save-raw instead of
+    the DLG, with the fields in new_column_name. Returns the same as export.
     '''
-    This loop with iterate through each item of list_json to convert each
-    item into a string so when creating the CSV, the excess qoutation marks and
-    brackets will go away. Plus we will handle the redirecting url's and copyright
-    issues with replacing the item with the thumbnails.
-    '''
-    for item in list_json:
-        for key in item.keys():
-
-            #Changing the list into one big string
-            if type(item[key]) == list:
-                text = item[key][0]
-                for i in range(1,len(item[key])):
-                    text += ', ' + item[key][i]
-                item[key] = text
-
-            #Changing the item URL
-            if key == 'edm_is_shown_by':
-                #Thumbnails
-                if item[key] == None:
-                    thumbnail_url = 'https://dlg.galileo.usg.edu/'
-                    try:
-                        repoID, collectionID, itemID = item['id'].split('_',2)
-                    except:
-                        print(item['id'])
-                    thumbnail_url += repoID +'/'+ collectionID +'/do-th:'+ itemID
-
-                    #Now grabbing the redirected url
-                    item[key] = requests.get(thumbnail_url).url
-                else:
-                    #Grabbing the redirected item for the
-                    try:
-                        item[key] = requests.get(item[key]).url
-                    except:
-                        print(item[key])
-    return list_json
+    if report is None:
+        report = RunReport()
+    index = RecordIndex()
+    rows = replay_raw(raw_files, new_column_name, options.separator, options.processes, index, report)
+    if len(rows) < 1:
+        print('There were no items in the raw files.')
+        return 0, index
+    write_rows(rows, csv_name, options, report)
+    return len(rows), index
+
+
+def run_batch(manifest, client, options):
+    '''
+    Runs every job in manifest, a CSV with input, output and mapping columns (a blank
+    mapping uses options.dlg), with up to options.jobs jobs at the same time. Every job
+    shares client, so they share its connections, cache and limit on requests in
+    flight. Returns a summary dictionary for each job, in the order of the manifest.
+    '''
+    with open(manifest, 'r', newline='') as manifest_file:
+        jobs = [job for job in csv.DictReader(manifest_file) if (job.get('input') or '').strip()]
+
+    #Each mapping is only read once, however many jobs use it
+    mappings = {}
+    for job in jobs:
+        job['mapping'] = (job.get('mapping') or '').strip() or options.dlg
+        if job['mapping'] not in mappings:
+            mappings[job['mapping']] = load_mapping(job['mapping'])
+
+    def run(job):
+        output = job['output'].strip()
+        report = RunReport(log=lambda message: print('{}: {}'.format(output, message)))
+        summary = {'input': job['input'].strip(), 'output': output, 'mapping': job['mapping'], 'status': 'done',
+                   'rows': 0, 'duplicates': 0}
+        try:
+            written, index = export(summary['input'], output, mappings[job['mapping']], client, options, report)
+            summary['rows'] = written
+            summary['duplicates'] = sum(index.duplicates.values())
+        except SystemExit:
+            #An export that cannot go on stops the script, which only needs to stop this job here
+            summary['status'] = 'stopped'
+        except Exception as e:
+            summary['status'] = 'failed: {}'.format(e)
+        summary.update(report.summary())
+        return summary
+
+    with ThreadPoolExecutor(max_workers=max(1, options.jobs)) as executor:
+        return list(executor.map(run, jobs))
 
 if __name__ == '__main__':
 
@@ -140,49 +1523,136 @@ if __name__ == '__main__':
                         API to then parse into a CSV. Then mapped to follow the \
                         DLGs column mapping to be uploaded into Omeka via CSV Import')
 
-    parser.add_argument('--input', dest='input', type=str, required=True,
+    parser.add_argument('--input', dest='input', type=str, default=None,
                         help=' The file that contains the URLs. \
                         Make sure there is one URL on each line of the file.')
-    parser.add_argument('--output', dest='output', type=str, required=True,
+    parser.add_argument('--output', dest='output', type=str, default=None,
                          help='The name of the output CSV file.')
+    parser.add_argument('--save-raw', dest='save_raw', type=str, default=None,
+                        help='A file to save the responses from the DLG to as gzipped JSON Lines, so the output \
+                        can be made again with --from-raw without requesting anything.')
+    parser.add_argument('--from-raw', dest='from_raw', type=str, nargs='+', default=None,
+                        help='Make the output from files saved with --save-raw instead of --input, with no requests \
+                        to the DLG. Use it to make the CSV again with a different mapping.')
+    parser.add_argument('--processes', dest='processes', type=int, default=1,
+                        help='With --from-raw, how many processes to read the files with. [Default: 1]')
+    parser.add_argument('--batch', dest='batch', type=str, default=None,
+                        help='A CSV of jobs to run instead of --input and --output, with input, output and \
+                        mapping columns. A blank mapping uses --mapping.')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=4,
+                        help='With --batch, how many jobs to run at the same time. They share --workers, \
+                        so no more than that many requests are made at once in total. [Default: 4]')
+    parser.add_argument('--format', dest='format', type=str, default='csv', choices=FORMATS,
+                        help='The kind of file to write: csv, jsonl (JSON Lines) or parquet. [Default: csv]')
+    parser.add_argument('--chunk-rows', dest='chunk_rows', type=int, default=0,
+                        help='Split the CSV into files of this many rows each, named after the output with \
+                        _001, _002 and so on. [Default: 0, one file]')
     parser.add_argument('--encode', dest='encode', type=str, default='utf-8',
                          help='The encoding preferred when writing to csv. [Default: UTF-8]')
     parser.add_argument('--mapping', dest='dlg', type=str, default='DLG_Mapping.csv',
                         help='The name of the dlg mapping CSV for column headings. \
                         Default: DLG_Mapping.csv')
+    parser.add_argument('--workers', dest='workers', type=int, default=4,
+                        help='The number of search result pages or item URL redirects to request at the same time. \
+                        [Default: 4]')
+    parser.add_argument('--cache-dir', dest='cache_dir', type=str, default=None,
+                        help='A folder to cache DLG API responses and redirected item URLs in, so later runs \
+                        with the same URLs do not request them again. [Default: no cache]')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='Ignore --cache-dir and request everything from the DLG.')
+    parser.add_argument('--cache-ttl', dest='cache_ttl', type=float, default=24,
+                        help='How many hours a cached response is used for. [Default: 24]')
+    parser.add_argument('--cache-max-size', dest='cache_max_size', type=float, default=500,
+                        help='The most megabytes the cache may use before the least recently used \
+                        responses are deleted. [Default: 500]')
+    parser.add_argument('--retries', dest='retries', type=int, default=4,
+                        help='How many times to retry a request after a server error or timeout. [Default: 4]')
+    parser.add_argument('--per-page', dest='per_page', type=int, default=0,
+                        help='How many items to ask for on each page of a search, so fewer pages are requested. \
+                        If the DLG gives fewer, its largest page size is used. [Default: 0, the DLG default]')
+    parser.add_argument('--shard-pages', dest='shard_pages', type=int, default=0,
+                        help='Split a search with more than this many pages into smaller searches, one for each \
+                        year, county or collection, which are grabbed at the same time. [Default: 0, never]')
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help='Write the CSV a batch of items at a time while they are grabbed, so memory use \
+                        stays the same however large the harvest is. Every column in the mapping is included.')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='Continue an interrupted --stream harvest from its journal (the output name \
+                        plus .journal), skipping the pages already in the CSV. Use the same --per-page.')
+    parser.add_argument('--state', dest='state', type=str, default=None,
+                        help='A JSON file of the item ids and versions from the last export. Only new or \
+                        changed items are written, and the file is updated for next time. Implies --stream.')
+    parser.add_argument('--deleted', dest='deleted', type=str, default=None,
+                        help='With --state, a text file to write the ids of items that were in the last \
+                        export but are gone now.')
+    parser.add_argument('--separator', dest='separator', type=str, default=', ',
+                        help='What to put between the values of a field with more than one value. [Default: ", "]')
+    parser.add_argument('--report', dest='report', type=str, default=None,
+                        help='A JSON file to write the time spent in each stage, request counts, bytes \
+                        downloaded, cache hits and errors to at the end of the run.')
+    parser.add_argument('--no-progress', dest='no_progress', action='store_true',
+                        help='Do not show the progress bar.')
     args = parser.parse_args()
+    if args.from_raw and not args.output:
+        parser.error('--output is required with --from-raw')
+    if not args.batch and not args.from_raw and not (args.input and args.output):
+        parser.error('--input and --output are required, unless --batch or --from-raw is used')
+    if args.batch and (args.state or args.save_raw):
+        parser.error('--state and --save-raw keep track of one export, so they cannot be used with --batch')
+    if args.batch and args.from_raw:
+        parser.error('--batch and --from-raw cannot be used together')
+    for raw_file in args.from_raw or []:
+        if not os.path.isfile(raw_file):
+            parser.error('--from-raw file {} does not exist'.format(raw_file))
+    if args.format == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        parser.error('--format parquet needs pyarrow. Install it with: pip install pyarrow')
 
 
-    url_file = args.input    #The File of URLs from the DLG
-    csv_name = args.output  #The name of the CSV output file.
-    encoding = args.encode  #File encoding
-    dlg_mapping = args.dlg  #What to map the DLG's field names to
+    #The cache of DLG responses, if one is wanted
+    cache = None
+    if args.cache_dir and not args.no_cache:
+        cache = ResponseCache(args.cache_dir, args.cache_ttl * 60 * 60, int(args.cache_max_size * 1024 * 1024))
 
-    #grabbing all of the URLs in the file to then be parsed
-    url_list = []
-    with open(url_file,'r') as dlg_urls:
-        for line in dlg_urls:
-            url_list.append(line.strip())
+    #Nothing is requested when the output is made from raw files
+    client = None if args.from_raw else DLGClient(args.workers, args.retries, cache=cache)
 
-    #Grabbing the complete list of jsons from the provided URLs
-    list_json = dlg_json2list(url_list)
-    df = pd.DataFrame.from_dict(list_json)
+    if args.batch:
+        summaries = run_batch(args.batch, client, args)
 
-    #Initalizing the DLG Mapping dict
-    new_column_name = {}
+        #How each job went
+        print('Jobs:')
+        for summary in summaries:
+            errors = sum(summary['errors'].values())
+            print('  {}: {}, {} rows, {} duplicates skipped, {} errors, {:.1f} s'.format(
+                summary['output'], summary['status'], summary['rows'], summary['duplicates'], errors,
+                summary['seconds']))
+    else:
+        #The progress bar is only drawn when the output is going to a terminal
+        show_progress = sys.stderr.isatty() and not args.no_progress
+        report = RunReport(progress_bar if show_progress else None)
 
-    #Grabbing the DLG Dublin Core Mapping
-    with open(dlg_mapping,'r') as map_csv:
-        w = csv.reader(map_csv)
-        for row in w:
-            new_column_name.update({row[0]:row[1]})
+        #Grabbing the DLG Dublin Core Mapping
+        new_column_name = load_mapping(args.dlg)
+
+        if args.from_raw:
+            written, index = export_raw(args.from_raw, args.output, new_column_name, args, report)
+        else:
+            written, index = export(args.input, args.output, new_column_name, client, args, report)
+        if show_progress:
+            sys.stderr.write('\n')
 
+        #Items that were in more than one of the searches
+        for line in index.report():
+            print(line)
 
-    #Creating Columns to drop
-    drop_columns = [col for col in list(df.columns) if col not in list(new_column_name.keys())]
-    df.drop(drop_columns, axis=1, inplace=True)
+    #How each host responded, to help tell a slow run from a struggling server
+    if not args.from_raw:
+        print('Requests by host:')
+        for line in client.report():
+            print('  ' + line)
 
-    #renaming the columns to map to Dublin Core and writing to csv
-    df.rename(columns = new_column_name,inplace=True)
-    df = df.sort_index(axis=1)
-    df.to_csv(csv_name,index=False)
+    if args.report and args.batch:
+        with open(args.report, 'w', encoding='utf-8') as report_file:
+            json.dump({'jobs': summaries, 'requests': client.summary()}, report_file, indent=2)
+    elif args.report:
+        report.save(args.report, client)
@@ -1,183 +1,116 @@
 """
 Parses JSON data from the DLG API into a CSV.
 A GUI is used to run the script so users don't need to interact with the command line.
-Threading is used so the GUI does not show an 'unresponsive' error because the script is running.
+The CSV is made by the same code as the command line script, dlg_json2csv.py, in a thread so the GUI stays
+responsive while it runs. The thread never touches the window: it sends events, which the window shows.
 """
 # Future development: should the user be notified of errors that don't quit the script, besides having the log made?
 
 import csv
 import os
-import pandas as pd
 import PySimpleGUI as sg
-import re
-import requests
 import sys
+from dlg_json2csv import Cancelled, DLGClient, Journal, RecordIndex, RunReport, load_mapping, read_urls, stream_csv
 
 # For threading.
 import threading
 import gc
 SCRIPT_THREAD = '-SCRIPT_THREAD-'
+PROGRESS = '-PROGRESS-'
+MESSAGE = '-MESSAGE-'
+POPUP = '-POPUP-'
 
 
-def dlg_json2list(url_list, output_location):
-    """Gets the JSON from th DLG API for every value in the url_list and results it as a list.
-    Makes a log for details about any problems in the same folder as the output."""
-    json_list = []
+class ErrorLog:
+    """The log of problems in the same folder as the output. Messages are kept until write(), which opens the file
+    once for all of them instead of once for each problem."""
 
-    for url in url_list:
+    def __init__(self, output_location):
+        self.path = f'{output_location}/error_log.txt'
+        self.messages = []
 
-        # Creates an API URL from the provided URL. Adds .json if not present, which goes in a different location
-        # depending on if the provided URL is from a search or for a single item.
-        is_api_url = type(re.search('.json', url)) == re.Match
-        is_search_result = type(re.search(r'\?', url)) == re.Match
-        if not is_api_url:
-            if is_search_result:
-                api_url = re.sub(r'\?', '.json?', url)
-            else:
-                api_url = re.sub(r'$', '.json', url)
-        else:
-            api_url = url
-
-        # Grabbing the response JSON.
-        try:
-            response = requests.get(api_url)
-            json_dict = response.json()
-        except:
-            with open(f'{output_location}/error_log.txt', 'a') as log:
-                log.write('\n\nCould not get data from the DLG API for the following URL:')
-                log.write(url)
-            continue
-
-        # Saving the response JSON to json_list.
-        if not is_search_result:
-            json_list.append(json_dict['response']['document'])
-
-        # If the URL is a search query, then we need to grab every item on every page.
+    def add(self, message):
+        self.messages.append(message)
+
+    def write(self):
+        if self.messages:
+            with open(self.path, 'a') as log:
+                log.write(''.join(self.messages))
+            self.messages = []
+
+
+class GUIReport(RunReport):
+    """The RunReport for the GUI, which explains the errors that dlg_json2csv.py only logs an item id or URL for,
+    and puts a blank line between them in the error log."""
+
+    MESSAGES = {'thumbnail': 'Could not parse the item id for the thumbnail url: ',
+                'redirect': 'Could not get redirected item: '}
+
+    def error(self, kind, message):
+        super().error(kind, '\n\n' + self.MESSAGES.get(kind, '') + str(message))
+
+
+def make_csv(urls, csv_name, new_column_name, output_location, client, workers, gui_window):
+    """Creates a CSV of data from the DLG API for all specified items. Runs in a thread, so it tells the GUI
+    how it is going with events instead of updating the window itself. Stops early if client is cancelled."""
+
+    # The progress is shown in the GUI's status line as each page is done, and the problems are saved for the log.
+    error_log = ErrorLog(output_location)
+    report = GUIReport(progress=lambda run: gui_window.write_event_value(PROGRESS, run.status()), log=error_log.add)
+    index = RecordIndex()
+
+    # Writes the CSV a page at a time as the items are grabbed, so memory use stays the same however big the
+    # export is. The CSV has every column in the mapping, in alphabetical order.
+    status = 'Done: '
+    try:
+        written = stream_csv(urls, csv_name, new_column_name, client, workers, index=index, report=report)
+
+        # Error Check. The CSV should have 1 or more items. Otherwise, the user is told to check the log.
+        if written < 1:
+            report.error('no_data', 'Could not get any data from the DLG API for this request')
+            gui_window.write_event_value(POPUP, "Unable to get any data for the provided input. See error_log.txt "
+                                                "in the output folder for more information.")
         else:
-            total_pages = json_dict['response']['pages']['total_pages']
-
-            # Saves the results from the first page of the API call to the list.
-            for item in json_dict['response']['docs']:
-                json_list.append(item)
-
-            # If there are multiple pages, calculates the api_url for all the other pages and adds them to the list.
-            # Stops when the total number of pages is reached.
-            if total_pages > 1:
-
-                # Range produces a sequence of numbers from 2 - last page number.
-                for page in range(2, total_pages + 1):
-
-                    # Create the api_url for the next page.
-                    page_str = 'page=' + str(page)
-                    if type(re.search(r'page=\d+', api_url)) == re.Match:
-                        api_url = re.sub(r'page=\d+', page_str, api_url)
-                    else:
-                        # For the first iteration, which doesn't have 'page=\d' yet.
-                        page_str = '?' + page_str + '&'
-                        api_url = re.sub(r'\?', page_str, api_url)
-
-                    # Grabbing the response and JSON for the new api_url.
-                    try:
-                        response = requests.get(api_url)
-                        json_dict = response.json()
-                    except:
-                        with open(f'{output_location}/error_log.txt', 'a') as log:
-                            log.write('\n\nCould not get data from the DLG API for the following page:')
-                            log.write(f'Page: {page}, API URL: {api_url}')
-                        continue
-
-                    # Saves the response to the list.
-                    for item in json_dict['response']['docs']:
-                        json_list.append(item)
-
-    # Error Check. json_list should have 1 or more items inside. Otherwise exit.
-    if len(json_list) < 1:
-        with open(f'{output_location}/error_log.txt', 'a', ) as log:
-            log.write('\n\nCould not get any data from the DLG API for this request')
-        sg.Popup("Unable to get any data for the provided input. See error_log.txt in the output folder for more "
-                 "information.")
-        sys.exit()
+            gui_window.write_event_value(MESSAGE, f"\nThe requested CSV has been made and is in the "
+                                                  f"{output_location} folder. You may submit information to create "
+                                                  f"another CSV or close this program.")
+    except Cancelled:
+        status = 'Stopped: '
+        gui_window.write_event_value(MESSAGE, "\nStopped. The CSV has the items grabbed before then.")
+    except Exception as e:
+        report.error('failed', f'The CSV could not be finished: {e}')
+        gui_window.write_event_value(POPUP, "The CSV could not be finished. See error_log.txt in the output folder "
+                                            "for more information.")
+    finally:
+        # Logs how many items were skipped because they were in more than one search.
+        if index.duplicates:
+            error_log.add('\n\nSkipped items that were already grabbed from an earlier URL:\n')
+            error_log.add('\n'.join(index.report()))
+        error_log.write()
+
+        # The GUI can't resume a harvest, so the checkpoints kept for one are not needed.
+        journal = Journal(csv_name)
+        if os.path.exists(journal.path):
+            os.remove(journal.path)
+
+        # The time spent in each stage, request counts and errors, for working out where the time went.
+        report.save(os.path.join(output_location, 'run_report.json'), client)
+        gui_window.write_event_value(PROGRESS, status + report.status())
+        gui_window.write_event_value(MESSAGE, "Requests by host:\n" + "\n".join(client.report()))
+
+        # For threading: indicates the thread for running the script is done.
+        gui_window.write_event_value(SCRIPT_THREAD, (threading.current_thread().name,))
+
+
+def start_csv(urls, new_column_name, values, output_csv, gui_window):
+    """Runs make_csv() in a thread with a new client, which is returned with the thread so the run can be stopped.
+    The thread is a daemon, so quitting the program does not wait for it."""
+    client = DLGClient(int(values["workers"]))
+    thread = threading.Thread(target=make_csv, args=(urls, output_csv, new_column_name, values["output_folder"],
+                                                     client, int(values["workers"]), gui_window), daemon=True)
+    thread.start()
+    return thread, client
 
-    '''This loop with iterate through each item of json_list to convert each item into a string so when creating the 
-    CSV, the excess quotation marks and brackets will go away. Plus we will handle the redirecting URLs and copyright 
-    issues with replacing the item with the thumbnails. '''
-    for item in json_list:
-        for key in item.keys():
-
-            # Changing the list into one big string.
-            if type(item[key]) == list:
-                text = item[key][0]
-                for i in range(1, len(item[key])):
-                    text += ', ' + item[key][i]
-                item[key] = text
-
-            # Changing the item URL.
-            if key == 'edm_is_shown_by':
-                # Thumbnails.
-                if item[key] is None:
-                    thumbnail_url = 'https://dlg.galileo.usg.edu/'
-                    try:
-                        repo_id, collection_id, item_id = item['id'].split('_', 2)
-                        thumbnail_url += repo_id + '/' + collection_id + '/do-th:' + item_id
-                    except:
-                        with open(f'{output_location}/error_log.txt', 'a') as log:
-                            log.write(f'\n\nCould not parse the item id for the thumbnail url: {item["id"]}')
-                        continue
-                    # Now grabbing the redirected URL.
-                    item[key] = requests.get(thumbnail_url).url
-                else:
-                    # Grabbing the redirected item.
-                    try:
-                        item[key] = requests.get(item[key]).url
-                    except:
-                        with open(f'{output_location}/error_log.txt', 'a') as log:
-                            log.write(f'\n\nCould not get redirected item: {item[key]}')
-
-    return json_list
-
-
-def make_csv(url_file, csv_name, dlg_mapping, output_location, gui_window):
-    """Creates a CSV of data from the DLG API for all specified items. """
-
-    # Grabbing all of the URLs in the file to then be parsed.
-    urls = []
-    with open(url_file, 'r') as dlg_urls:
-        for line in dlg_urls:
-            urls.append(line.strip())
-
-    # Grabbing the complete list of JSONs from the provided URLs and making a dataframe.
-    jsons = dlg_json2list(urls, output_location)
-    df = pd.DataFrame.from_dict(jsons)
-
-    # Initializing the DLG Mapping dict.
-    new_column_name = {}
-
-    # Grabbing the DLG Dublin Core Mapping.
-    with open(dlg_mapping, 'r') as map_csv:
-        w = csv.reader(map_csv)
-        for row in w:
-            new_column_name.update({row[0]: row[1]})
-
-    # Dropping columns from the dataframe if they are not in the DLG Mapping.
-    drop_columns = [col for col in list(df.columns) if col not in list(new_column_name.keys())]
-    df.drop(drop_columns, axis=1, inplace=True)
-
-    # Renaming the columns to map to Dublin Core and writing to CSV.
-    df.rename(columns=new_column_name, inplace=True)
-    df = df.sort_index(axis=1)
-    df.to_csv(csv_name, index=False)
-
-    # Communicate that the script has completed to user in the GUI dialogue box.
-    print(f"\nThe requested CSV has been made and is in the {output_location} folder. "
-          f"You may submit information to create another CSV or close this program.")
-    window.Refresh()
-
-    # For threading: indicates the thread for running the script is done.
-    gui_window.write_event_value('-SCRIPT_THREAD-', (threading.current_thread().name,))
-
-
-# For threading. Disables garbage collecting, which is restarted with gc.collect() once the GUI starts.
-gc.disable()
 
 # Defines a GUI for users to provide the input needed for this script and
 # to receive messages about errors to their inputs and the script progress.
@@ -187,7 +120,7 @@ layout_one = [[sg.Text('Path to file with DLG URLs', font=("roboto", 13))],
               [sg.Text('Folder to save output', font=("roboto", 13))],
               [sg.Text('Name for the output CSV', font=("roboto", 13))],
               [sg.Text(font=("roboto", 1))],
-              [sg.Submit(key="submit", disabled=False), sg.Cancel()]]
+              [sg.Submit(key="submit", disabled=False), sg.Button("Stop", key="stop", disabled=True), sg.Cancel()]]
 
 layout_two = [[sg.Input(key="input_file"), sg.FileBrowse()],
               [sg.Input(key="output_folder"), sg.FolderBrowse()],
@@ -196,28 +129,52 @@ layout_two = [[sg.Input(key="input_file"), sg.FileBrowse()],
               [sg.Text(font=("roboto", 13))]]
 
 layout_three = [[sg.Text("Mapping", font=("roboto", 13)),
-                 sg.Input(default_text="DLG_Mapping.csv", key="mapping_csv"), sg.FileBrowse()]]
+                 sg.Input(default_text="DLG_Mapping.csv", key="mapping_csv"), sg.FileBrowse()],
+                [sg.Text("Requests to make at once", font=("roboto", 13)),
+                 sg.Input(default_text="4", key="workers", size=(5, 1))]]
 
 layout = [[sg.Column(layout_one), sg.Column(layout_two)],
           [sg.Frame("Optional", layout_three, font=("roboto", 15))],
+          [sg.Text(size=(90, 1), key="status")],
           [sg.Output(size=(90, 10))]]
 
 window = sg.Window("DLG API Parser: Make a CSV from DLG Metadata", layout)
 
+# The thread making the CSV and its client, which is cancelled to stop it. None when no CSV is being made.
+processing_thread = None
+client = None
+
 # Keeps the GUI open until the user quits the program. Receives user input, verifies the input,
 # and when all input is correct runs the program.
 # Future development: add a "reset" button to get the GUI back to original values?
 while True:
 
-    # For threading: start garbage collecting.
-    gc.collect()
-
     # Gets the user input data and saves the input values to their own variables for easier referencing in the script.
     event, values = window.read()
 
     # For threading: let the user submit new information now that the script thread is over.
     if event == SCRIPT_THREAD:
-        window[f'{"submit"}'].update(disabled=False)
+        processing_thread.join()
+        processing_thread = None
+        client = None
+        # The run is over, so what it left behind is freed in one go instead of waiting for the next collection.
+        gc.collect()
+        window["submit"].update(disabled=False)
+        window["stop"].update(disabled=True)
+
+    # For threading: show how far along the script thread is, and its messages.
+    if event == PROGRESS:
+        window["status"].update(values[PROGRESS])
+    if event == MESSAGE:
+        print(values[MESSAGE])
+    if event == POPUP:
+        sg.Popup(values[POPUP])
+
+    # Stops the CSV being made. The requests already sent are finished, then the thread ends.
+    if event == "stop" and client is not None:
+        client.cancel()
+        window["stop"].update(disabled=True)
+        print("\nStopping...")
 
     # If the user submitted values, tests they are correct. If not, errors are displayed. If yes, the script is run.
     # Future development: change formatting on boxes with errors to highlight them?
@@ -244,10 +201,27 @@ while True:
             errors.append("Mapping CSV can't be blank. Use DLG_Mapping.csv for the default.")
         if not os.path.exists(values["mapping_csv"]):
             errors.append("Mapping CSV path is not correct.")
+        if not values["workers"].isdigit() or int(values["workers"]) < 1:
+            errors.append("Requests to make at once must be a whole number of 1 or more. Use 4 for the default.")
 
         # If the user inputs are correct, verifies if the output CSV exists and runs the script if it does not
         # OR if the user agrees to overwrite the existing CSV. If the user does not want to overwrite an existing CSV,
         # no CSV is made and the user must resubmit the input.
+        # Grabbing all of the URLs in the file to then be parsed, with the same search or item only grabbed once,
+        # and the DLG Dublin Core Mapping. These are read here, not in the thread, since they may print to the window,
+        # and a file that can't be read is reported like the other input errors.
+        if len(errors) == 0:
+            try:
+                urls = read_urls(values["input_file"])
+            except (OSError, UnicodeDecodeError) as e:
+                errors.append(f"Input CSV could not be read: {e}")
+            try:
+                new_column_name = load_mapping(values["mapping_csv"])
+            except IndexError:
+                errors.append("Mapping CSV must have two columns in every row: the DLG field and the column name.")
+            except (OSError, UnicodeDecodeError, csv.Error) as e:
+                errors.append(f"Mapping CSV could not be read: {e}")
+
         if len(errors) == 0:
 
             # Makes a variable for the full path to the CSV for the output from two user inputs,
@@ -258,26 +232,13 @@ while True:
 
             # If the CSV for the script output already exists, prompt the user to decide if it should be overwritten.
             # If the user indicates yes, the script is run. Otherwise, the user can correct the input and resubmit.
-            if os.path.exists(output_csv):
-                override = sg.PopupYesNo("Do you want to replace the existing CSV?")
-                if override == "Yes":
-                    # For threading: run make_csv() in a thread.
-                    processing_thread = threading.Thread(target=make_csv, args=(values["input_file"], output_csv,
-                                                                                values["mapping_csv"],
-                                                                                values["output_folder"], window))
-                    processing_thread.start()
-                    # Disable the submit button while make_csv() is running so users can't overwhelm computing resources
-                    # by requesting new CSVs before the first is done being created.
-                    window[f'{"submit"}'].update(disabled=True)
-            else:
+            if not os.path.exists(output_csv) or sg.PopupYesNo("Do you want to replace the existing CSV?") == "Yes":
                 # For threading: run make_csv() in a thread.
-                processing_thread = threading.Thread(target=make_csv, args=(values["input_file"], output_csv,
-                                                                            values["mapping_csv"],
-                                                                            values["output_folder"], window))
-                processing_thread.start()
+                processing_thread, client = start_csv(urls, new_column_name, values, output_csv, window)
                 # Disable the submit button while make_csv() is running so users can't overwhelm computing resources
                 # by requesting new CSVs before the first is done being created.
-                window[f'{"submit"}'].update(disabled=True)
+                window["submit"].update(disabled=True)
+                window["stop"].update(disabled=False)
 
         # If some of the user inputs were not correct, creates a pop up box alerting the user to the problem
         # and prints the errors in the GUI dialogue box.
@@ -288,6 +249,8 @@ while True:
             print("\n".join(errors))
             window.Refresh()
 
-    # If the user clicked cancel or the X on the GUI, quites the script.
+    # If the user clicked cancel or the X on the GUI, stops any CSV being made and quits the script.
     if event in ("Cancel", None):
+        if client is not None:
+            client.cancel()
         sys.exit()